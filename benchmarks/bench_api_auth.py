@@ -0,0 +1,34 @@
+"""
+Latency of an authenticated ingestion API request with the API key cache and
+without it. Needs POSTGRES_URI and REDIS_URL, and an organization to
+authenticate as.
+
+    python benchmarks/bench_api_auth.py <organization name>
+"""
+import base64
+import sys
+import timeit
+
+from pipet import app
+from pipet.api import auth
+from pipet.models import Organization
+
+
+def main(name, number=2000):
+    with app.app_context():
+        organization = Organization.query.filter_by(name=name).one()
+        credentials = base64.b64encode('{}:{}'.format(
+            organization.name, organization.api_key).encode('utf-8')).decode('ascii')
+    headers = {'Authorization': 'Basic ' + credentials}
+    client = app.test_client()
+
+    for label, ttl in [('uncached', 0), ('cached', auth.API_AUTH_TTL)]:
+        auth.cache.ttl = ttl
+        auth.cache.clear()
+        seconds = timeit.timeit(
+            lambda: client.get('/api/buffer', headers=headers), number=number)
+        print('{:<10} {:8.3f} ms/request'.format(label, seconds / number * 1e3))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
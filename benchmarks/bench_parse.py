@@ -0,0 +1,75 @@
+"""
+Cost of converting an API object to a row, comparing the precompiled parse
+plans with the previous per-column parser, on recorded payloads.
+
+    python benchmarks/bench_parse.py
+"""
+from datetime import datetime
+import json
+import os
+import timeit
+
+from sqlalchemy.types import DateTime
+
+from pipet.sources.stripe.models import Charge
+from pipet.sources.zendesk.models import Ticket
+
+
+PAYLOADS = os.path.join(os.path.dirname(__file__), 'payloads')
+
+
+def legacy_stripe_parse(cls, data):
+    d = {}
+    for field, column in cls.__table__._columns.items():
+        if field == 'meta':
+            data_field = 'metadata'
+        elif field[-3:] == '_id':
+            data_field = field[:-3]
+        else:
+            data_field = field
+        value = data.get(data_field, None)
+        if not value:
+            continue
+        elif isinstance(column.type, DateTime):
+            d[field] = datetime.fromtimestamp(value)
+        else:
+            d[field] = value
+    return d
+
+
+def legacy_zendesk_parse(cls, data):
+    d = {}
+    for field, column in cls.__table__._columns.items():
+        value = data.get('meta' if field == 'metadata' else field, None)
+        if not value:
+            continue
+        elif isinstance(column.type, DateTime):
+            d[field] = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+        else:
+            d[field] = value
+    return d
+
+
+def load(name):
+    with open(os.path.join(PAYLOADS, name)) as fp:
+        return json.load(fp)
+
+
+def main(number=20000):
+    cases = [
+        ('stripe charge', Charge, legacy_stripe_parse,
+         load('stripe_charges.json')['data'][0]),
+        ('zendesk ticket', Ticket, legacy_zendesk_parse,
+         load('zendesk_tickets.json')['tickets'][0]),
+    ]
+
+    for name, cls, legacy, data in cases:
+        assert cls.parse(data) == legacy(cls, data)
+        before = timeit.timeit(lambda: legacy(cls, data), number=number)
+        after = timeit.timeit(lambda: cls.parse(data), number=number)
+        print('{:<16} legacy {:7.2f} us/row  plan {:7.2f} us/row  {:.1f}x'.format(
+            name, before / number * 1e6, after / number * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    main()
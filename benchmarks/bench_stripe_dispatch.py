@@ -0,0 +1,33 @@
+"""
+Per-event cost of finding the model class for a Stripe event object.
+
+    python benchmarks/bench_stripe_dispatch.py
+"""
+from inspect import isclass
+import timeit
+
+from pipet.sources.stripe import get_class_for_object_type
+from pipet.sources.stripe.models import Base, CLASS_REGISTRY, MODELS
+
+
+def legacy_get_class_for_object_type(object_type):
+    try:
+        return [m for n, m in CLASS_REGISTRY.items() if isclass(m) and issubclass(m, Base) and object_type == m.object_type()][0]
+    except IndexError:
+        raise ValueError(
+            'No matching class found for object %s ' % object_type)
+
+
+def main(number=20000):
+    object_types = [m.object_type() for m in MODELS]
+
+    for name, func in [('legacy scan', legacy_get_class_for_object_type),
+                       ('dispatch index', get_class_for_object_type)]:
+        seconds = timeit.timeit(
+            lambda: [func(t) for t in object_types], number=number)
+        per_event = seconds / (number * len(object_types))
+        print('{:<16} {:8.3f} us/event'.format(name, per_event * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,11 +11,13 @@ from flask_sqlalchemy import Model
 from flask_wtf.csrf import CSRFProtect
 from raven.contrib.flask import Sentry
 from raven.contrib.celery import register_logger_signal, register_signal
+from redis import StrictRedis
 from sqlalchemy import Column
 from sqlalchemy.sql import func
 from sqlalchemy.types import DateTime, Integer
 
 from pipet.utils.celery import make_celery
+from pipet.utils.metrics import Metrics
 
 
 class Base(Model):
@@ -52,6 +54,9 @@ sentry.init_app(app)
 login_manager.init_app(app)
 login_manager.login_view = 'index'
 celery = make_celery(app)
+redis_client = StrictRedis.from_url(
+    os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+metrics = Metrics(redis_client)
 celery.conf.ONCE = {
     'backend': 'celery_once.backends.Redis',
     'settings': {
@@ -72,31 +77,47 @@ def load_user(user_id):
 from pipet import views  # NOQA
 from pipet import cli  # NOQA
 
-# from pipet.api.views import blueprint as api_blueprint
+from pipet.api.buffer import INGEST_FLUSH_INTERVAL
+from pipet.api.views import blueprint as api_blueprint
+from pipet.api.tasks import flush_all as api_flush_all, maintain_partitions
+
+
+app.register_blueprint(api_blueprint, url_prefix='/api')
 
-# app.register_blueprint(api_blueprint, url_prefix='/api')
 
 from pipet.sources.zendesk import ZendeskAccount
 from pipet.sources.zendesk.views import blueprint as zendesk_blueprint
-from pipet.sources.zendesk.tasks import sync as zendesk_sync_all
+from pipet.sources.zendesk import tasks as zendesk_tasks
 
 
 app.register_blueprint(zendesk_blueprint, url_prefix='/zendesk')
 
 
-@celery.on_after_configure.connect
-def setup_periodic_tasks(sender, **kwargs):
-    sender.add_periodic_task(60, zendesk_sync_all.s(), name='test')
-
-
 from pipet.sources.stripe import StripeAccount
 from pipet.sources.stripe.views import blueprint as stripe_blueprint
-from pipet.sources.stripe.tasks import sync_all as stripe_sync_all
+from pipet.sources.stripe import tasks as stripe_tasks
+from pipet.sources.stripe.webhooks import blueprint as stripe_webhooks_blueprint
 
 
 app.register_blueprint(stripe_blueprint, url_prefix='/stripe')
+app.register_blueprint(stripe_webhooks_blueprint, url_prefix='/stripe/webhooks')
+
+
+from pipet import monitoring  # NOQA
+from pipet.utils.raw import MATERIALIZE_INTERVAL, RAW_LANDING
+from pipet.utils.scheduler import SYNC_DISPATCH_INTERVAL
 
 
 @celery.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
-    sender.add_periodic_task(60, stripe_sync_all.s(), name='test')
+    sender.add_periodic_task(INGEST_FLUSH_INTERVAL, api_flush_all.s(), name='api_flush_all')
+    sender.add_periodic_task(60 * 60, maintain_partitions.s(), name='maintain_partitions')
+
+    # Accounts are synced when the adaptive schedule says they're due
+    for name, tasks in [('zendesk', zendesk_tasks), ('stripe', stripe_tasks)]:
+        sender.add_periodic_task(SYNC_DISPATCH_INTERVAL, tasks.dispatch.s(),
+                                 name='{}_dispatch'.format(name))
+        sender.add_periodic_task(60, tasks.enroll.s(), name='{}_enroll'.format(name))
+        if RAW_LANDING:
+            sender.add_periodic_task(MATERIALIZE_INTERVAL, tasks.materialize_all.s(),
+                                     name='{}_materialize'.format(name))
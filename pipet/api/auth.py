@@ -0,0 +1,167 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from flask import request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import object_session
+
+from pipet import redis_client
+from pipet.models import Organization
+
+
+# Seconds a successful API key lookup is cached, 0 disables the cache
+API_AUTH_TTL = int(os.environ.get('API_AUTH_TTL', 300))
+# Seconds a failed lookup is cached
+API_AUTH_NEGATIVE_TTL = int(os.environ.get('API_AUTH_NEGATIVE_TTL', 30))
+API_AUTH_MAX_ENTRIES = int(os.environ.get('API_AUTH_MAX_ENTRIES', 10000))
+# Seconds between checks for keys rotated by other processes
+API_AUTH_CHECK_INTERVAL = float(os.environ.get('API_AUTH_CHECK_INTERVAL', 1))
+
+
+def lookup(username, password):
+    """
+    Return:
+        int: id of the organization the credentials belong to, or None
+    """
+    try:
+        api_key = uuid.UUID(password)
+    except (TypeError, ValueError):
+        return None
+    organization = Organization.query.filter_by(
+        name=username, api_key=api_key).first()
+    return organization.id if organization else None
+
+
+class AuthCache():
+    """
+    Per-process cache of basic-auth credentials to organization ids, so the
+    ingestion endpoints don't query the app database on every request.
+
+    Failed lookups are cached too, for `negative_ttl` seconds, so bad
+    credentials can't be used to hammer the database. Rotating an
+    organization's `api_key` bumps a generation counter in Redis, and every
+    process drops its cache within `check_interval` seconds of seeing it.
+    """
+
+    GENERATION_KEY = 'auth:generation'
+
+    def __init__(self, redis, lookup=lookup, ttl=API_AUTH_TTL,
+                 negative_ttl=API_AUTH_NEGATIVE_TTL, max_entries=API_AUTH_MAX_ENTRIES,
+                 check_interval=API_AUTH_CHECK_INTERVAL):
+        self.redis = redis
+        self.lookup = lookup
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self.hits = self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._generation = None
+        self._checked = 0
+
+    def _key(self, username, password):
+        # Don't keep plaintext API keys around
+        return hashlib.sha256('{}:{}'.format(username, password).encode('utf-8')).digest()
+
+    def _check_generation(self, now):
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        generation = self.redis.get(self.GENERATION_KEY)
+        if generation != self._generation:
+            self._generation = generation
+            self.clear()
+
+    def authenticate(self, username, password):
+        """
+        Return:
+            int: id of the organization the credentials belong to, or None
+        """
+        if not self.ttl:
+            return self.lookup(username, password)
+
+        now = time.time()
+        self._check_generation(now)
+        key = self._key(username, password)
+        entry = self._entries.get(key)
+        if entry and entry[1] > now:
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        organization_id = self.lookup(username, password)
+        ttl = self.ttl if organization_id else self.negative_ttl
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._evict(now)
+            self._entries[key] = (organization_id, now + ttl)
+        return organization_id
+
+    def _evict(self, now):
+        expired = [k for k, (_, expires) in self._entries.items() if expires <= now]
+        for k in expired:
+            del self._entries[k]
+        if len(self._entries) >= self.max_entries:
+            # Still full of live entries, start over rather than track LRU
+            self._entries.clear()
+
+    def invalidate(self, organization_id):
+        """
+        Forget an organization's credentials in this process and tell the
+        others to do the same.
+        """
+        with self._lock:
+            self._entries = {k: v for k, v in self._entries.items()
+                             if v[0] != organization_id}
+        self.redis.incr(self.GENERATION_KEY)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+cache = AuthCache(redis_client)
+
+
+def authenticate():
+    """
+    Return:
+        int: id of the organization authenticated by the request's basic-auth
+            credentials, or None
+    """
+    auth = request.authorization
+    if not auth or not auth.username or not auth.password:
+        return None
+    return cache.authenticate(auth.username, auth.password)
+
+
+@event.listens_for(Organization, 'after_update')
+def api_key_rotated(mapper, connection, target):
+    if inspect(target).attrs.api_key.history.has_changes():
+        # Invalidate once the new key is committed, or other processes
+        # could cache the old one again in the meantime
+        object_session(target).info.setdefault(
+            'rotated_organizations', set()).add(target.id)
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def invalidate_rotated(session):
+    for organization_id in session.info.pop('rotated_organizations', ()):
+        cache.invalidate(organization_id)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def discard_rotated(session):
+    session.info.pop('rotated_organizations', None)
@@ -0,0 +1,144 @@
+import json
+import os
+
+from pipet.sources import Event, Group, Identity, Page
+
+
+# Rows buffered for an organization before a flush is triggered
+INGEST_FLUSH_ROWS = int(os.environ.get('INGEST_FLUSH_ROWS', 1000))
+# Seconds between periodic flushes of every buffer
+INGEST_FLUSH_INTERVAL = int(os.environ.get('INGEST_FLUSH_INTERVAL', 10))
+# Rows buffered for an organization before requests are refused
+INGEST_MAX_BUFFERED = int(os.environ.get('INGEST_MAX_BUFFERED', 100000))
+# Failed flushes in a row before the rows being flushed are dead-lettered
+INGEST_MAX_ATTEMPTS = int(os.environ.get('INGEST_MAX_ATTEMPTS', 5))
+
+KINDS = ('event', 'page', 'identity', 'group')
+MODELS = {
+    'event': Event,
+    'page': Page,
+    'identity': Identity,
+    'group': Group,
+}
+
+
+class BufferFull(Exception):
+    pass
+
+
+class IngestBuffer():
+    """
+    Per-organization buffer of validated rows in Redis lists, one per kind,
+    shared by every web process and drained by the flush task.
+    """
+
+    def __init__(self, redis, max_buffered=INGEST_MAX_BUFFERED,
+                 max_attempts=INGEST_MAX_ATTEMPTS):
+        self.redis = redis
+        self.max_buffered = max_buffered
+        self.max_attempts = max_attempts
+
+    def key(self, organization_id, kind):
+        return 'ingest:{}:{}'.format(organization_id, kind)
+
+    def sizes(self, organization_id):
+        """
+        Return:
+            dict: number of buffered rows by kind
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for kind in KINDS:
+            pipe.llen(self.key(organization_id, kind))
+        return dict(zip(KINDS, pipe.execute()))
+
+    def push(self, organization_id, rows):
+        """
+        Args:
+            organization_id (int):
+            rows (list): (kind, row) tuples
+        Return:
+            int: rows buffered for the organization after the push
+        Raise:
+            BufferFull: the buffer is over `max_buffered`, nothing was pushed
+        """
+        buffered = sum(self.sizes(organization_id).values())
+        if buffered + len(rows) > self.max_buffered:
+            raise BufferFull(buffered)
+
+        pipe = self.redis.pipeline(transaction=False)
+        for kind, row in rows:
+            pipe.rpush(self.key(organization_id, kind), json.dumps(row))
+        pipe.sadd('ingest:organizations', organization_id)
+        pipe.execute()
+        return buffered + len(rows)
+
+    def pop(self, organization_id, kind, count):
+        """
+        Atomically take up to `count` rows of a kind off the buffer.
+        """
+        key = self.key(organization_id, kind)
+        pipe = self.redis.pipeline()
+        pipe.lrange(key, 0, count - 1)
+        pipe.ltrim(key, count, -1)
+        rows, _ = pipe.execute()
+        return [json.loads(row) for row in rows]
+
+    def requeue(self, organization_id, kind, rows):
+        """
+        Put popped rows back at the front of the buffer, e.g. after a failed
+        write, so they're retried by the next flush.
+        """
+        if rows:
+            self.redis.lpush(self.key(organization_id, kind),
+                             *[json.dumps(row) for row in reversed(rows)])
+
+    def failed(self, organization_id):
+        """
+        Count a failed flush.
+
+        Return:
+            bool: True if the flush failed `max_attempts` times in a row, and
+                its rows should be dead-lettered rather than retried
+        """
+        key = 'ingest:{}:failures'.format(organization_id)
+        pipe = self.redis.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, 24 * 60 * 60)
+        failures, _ = pipe.execute()
+        if failures >= self.max_attempts:
+            self.redis.delete(key)
+            return True
+        return False
+
+    def succeeded(self, organization_id):
+        self.redis.delete('ingest:{}:failures'.format(organization_id))
+
+    def dead_letter(self, organization_id, kind, rows):
+        """
+        Set aside rows that keep failing to write, so they stop blocking the
+        rest of the buffer. They're kept for inspection, not retried.
+        """
+        if rows:
+            self.redis.rpush(self.key(organization_id, kind) + ':dead',
+                             *[json.dumps(row) for row in rows])
+
+    def dead_lettered(self, organization_id):
+        """
+        Return:
+            dict: number of dead-lettered rows by kind
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for kind in KINDS:
+            pipe.llen(self.key(organization_id, kind) + ':dead')
+        return dict(zip(KINDS, pipe.execute()))
+
+    def organizations(self):
+        return [int(i) for i in self.redis.smembers('ingest:organizations')]
+
+    def discard(self, organization_id):
+        """
+        Forget an organization whose buffers are empty. Rows pushed in the
+        meantime re-add it.
+        """
+        if not any(self.sizes(organization_id).values()):
+            self.redis.srem('ingest:organizations', organization_id)
@@ -1,12 +1,104 @@
-from pipet import celery
+import logging
+import time
+
+from celery import group
+from celery_once import QueueOnce
+
+from pipet import app, celery, metrics, redis_client
+from pipet.api.buffer import INGEST_FLUSH_ROWS, IngestBuffer, KINDS, MODELS
 from pipet.models import Organization
+from pipet.sources import APPEND_ONLY_MODELS
+from pipet.utils import UpsertBatch
+from pipet.utils.bulk import copy_rows
+
+
+buffer = IngestBuffer(redis_client)
+logger = logging.getLogger(__name__)
+
+
+@celery.task(base=QueueOnce, once={'graceful': True})
+def flush(organization_id):
+    """
+    Drain an organization's buffer into its warehouse, `INGEST_FLUSH_ROWS`
+    rows of each kind per transaction. Events and pages are appended with
+    COPY, identities and groups are upserted.
+
+    Rows that fail to write go back to the front of the buffer for the next
+    flush. After `INGEST_MAX_ATTEMPTS` failures in a row they're
+    dead-lettered instead, so a bad row can't block the buffer forever.
+    """
+    with app.app_context():
+        organization = Organization.query.get(organization_id)
+        session = organization.create_session()
+        try:
+            while True:
+                popped = {kind: buffer.pop(organization_id, kind, INGEST_FLUSH_ROWS)
+                          for kind in KINDS}
+                if not any(popped.values()):
+                    break
+
+                batch = UpsertBatch()
+                appends = []
+                for kind, rows in popped.items():
+                    model = MODELS[kind]
+                    if model in APPEND_ONLY_MODELS:
+                        appends.append((model.__table__, rows))
+                    else:
+                        for row in rows:
+                            batch.upsert(model, row)
+
+                try:
+                    start = time.time()
+                    conn = session.connection()
+                    written = {}
+                    for table, rows in appends:
+                        if rows:
+                            copy_rows(conn, table, rows)
+                            written[table.name] = len(rows)
+                    written.update(batch.execute(conn))
+                    session.commit()
+                    buffer.succeeded(organization_id)
+                    metrics.record_write(written, time.time() - start, skipped=batch.skipped,
+                                         source='api', account=organization_id)
+                except Exception:
+                    session.rollback()
+                    if buffer.failed(organization_id):
+                        logger.exception('Dead-lettering rows of <Organization {}> after {} '
+                                         'failed flushes'.format(organization_id, buffer.max_attempts))
+                        for kind, rows in popped.items():
+                            buffer.dead_letter(organization_id, kind, rows)
+                        continue
+                    for kind, rows in popped.items():
+                        buffer.requeue(organization_id, kind, rows)
+                    raise
+        finally:
+            session.close()
+        buffer.discard(organization_id)
 
 
 @celery.task
-def process_event(organization_id, data):
-    pass
+def flush_all():
+    job = group([flush.s(organization_id)
+                 for organization_id in buffer.organizations()])
+    job.apply_async()
 
 
 @celery.task
-def process_page(organization_id, data):
-    pass
+def maintain_partitions():
+    """
+    Create the schema and upcoming partitions for every organization with a
+    warehouse, and drop partitions past retention.
+    """
+    with app.app_context():
+        for organization in Organization.query.filter(
+                Organization.database_credentials.isnot(None)):
+            session = organization.create_session()
+            try:
+                organization.create_all(session)
+                session.commit()
+            except Exception:
+                session.rollback()
+                logger.exception(
+                    'Partition maintenance failed for {}'.format(organization))
+            finally:
+                session.close()
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta, timezone
+import json
+import uuid
+
+from dateutil.parser import isoparse
+
+from pipet.api.buffer import MODELS
+from pipet.utils.partitions import PARTITION_PRECREATE_DAYS
+
+
+REQUIRED = {
+    'event': ('type', ),
+    'page': ('url', 'anonymous_id'),
+    'identity': ('id', 'type', 'source', 'source_id'),
+    'group': ('user_id', 'group_id'),
+}
+COLUMNS = {kind: frozenset(model.__table__.columns.keys())
+           for kind, model in MODELS.items()}
+
+
+class ValidationError(Exception):
+    pass
+
+
+def parse_timestamp(value):
+    """
+    Args:
+        value (str): ISO 8601 timestamp, assumed UTC without an offset
+    Return:
+        datetime: naive UTC
+    Raise:
+        ValidationError: `value` isn't a timestamp
+    """
+    if not isinstance(value, str):
+        raise ValidationError('created must be an ISO 8601 timestamp')
+    try:
+        created = isoparse(value)
+    except ValueError:
+        raise ValidationError('created must be an ISO 8601 timestamp')
+    if created.tzinfo:
+        created = created.astimezone(timezone.utc).replace(tzinfo=None)
+    return created
+
+
+def check_partition_range(kind, created, now=None):
+    """
+    Rows of partitioned tables must fall between their retention and the
+    last partition created ahead of time. Anything else would land in the
+    default partition, which retention never drops and which blocks the
+    creation of partitions overlapping its rows.
+
+    Raise:
+        ValidationError: `created` is out of range
+    """
+    info = MODELS[kind].__table__.info
+    if 'partition_interval' not in info:
+        return
+    today = (now or datetime.utcnow()).date()
+    if created.date() >= today + timedelta(days=PARTITION_PRECREATE_DAYS):
+        raise ValidationError('created is more than {} days ahead'.format(
+            PARTITION_PRECREATE_DAYS - 1))
+    retention_days = info.get('retention_days')
+    if retention_days and created.date() < today - timedelta(days=retention_days):
+        raise ValidationError('created is older than the {} days kept'.format(retention_days))
+
+
+def validate(kind, data):
+    """
+    Cheap structural checks only: required fields are present, `created`
+    is a timestamp within the partitioned range and unknown keys are
+    dropped. Anything else is left to the warehouse.
+    """
+    if not isinstance(data, dict):
+        raise ValidationError('{} must be an object'.format(kind))
+    missing = [f for f in REQUIRED[kind] if not data.get(f)]
+    if missing:
+        raise ValidationError('{} is missing {}'.format(kind, ', '.join(missing)))
+
+    row = {k: v for k, v in data.items() if k in COLUMNS[kind]}
+    if row.get('created') is None:
+        row['created'] = datetime.utcnow().isoformat()
+    else:
+        created = parse_timestamp(row['created'])
+        check_partition_range(kind, created)
+        row['created'] = created.isoformat()
+    if kind == 'event':
+        row.setdefault('uuid', uuid.uuid4().hex)
+    elif kind == 'page' and not isinstance(row.get('data'), (str, type(None))):
+        row['data'] = json.dumps(row['data'])
+    return row
+
+
+def parse_payload(kind, data):
+    """
+    Args:
+        data: decoded request body, a single object or a list of objects of
+            one kind, None if it wasn't JSON
+    Return:
+        list: (kind, data) tuples
+    """
+    if data is None:
+        raise ValidationError('Request body must be JSON')
+    return [(kind, d) for d in (data if isinstance(data, list) else [data])]
+
+
+def parse_batch(data):
+    """
+    Args:
+        data: decoded request body, `{"batch": [{"kind": "event", ...}, ...]}`
+    Return:
+        list: (kind, data) tuples
+    """
+    if not isinstance(data, dict):
+        raise ValidationError('Request body must be a JSON object')
+    rows = []
+    for d in data.get('batch') or []:
+        if not isinstance(d, dict) or d.get('kind') not in REQUIRED:
+            raise ValidationError('Every batch item needs a valid kind')
+        rows.append((d['kind'], d))
+    return rows
@@ -1,37 +1,88 @@
-from flask import Blueprint, request
+from flask import Blueprint, jsonify, request
 
-from pipet.sources import SCHEMANAME, Event, Group, Identity, Page
-from pipet.sources.api.tasks import process_event, process_page
+from pipet import csrf
+from pipet.api.auth import authenticate
+from pipet.api.buffer import BufferFull, INGEST_FLUSH_INTERVAL, INGEST_FLUSH_ROWS
+from pipet.api.tasks import buffer, flush
+from pipet.api.validation import ValidationError, parse_batch, parse_payload, validate
 
 
-blueprint = Blueprint(SCHEMANAME, __name__)
+blueprint = Blueprint('api', __name__)
+csrf.exempt(blueprint)
+
+
+def ingest(parse):
+    """
+    Args:
+        parse: returns the (kind, data) tuples of the request, raising
+            `ValidationError` if the body can't be read
+    """
+    organization_id = authenticate()
+    if not organization_id:
+        return jsonify(error='Unauthorized'), 401
+
+    try:
+        rows = [(kind, validate(kind, data)) for kind, data in parse()]
+    except ValidationError as e:
+        return jsonify(error=str(e)), 400
+
+    try:
+        buffered = buffer.push(organization_id, rows)
+    except BufferFull as e:
+        # Backpressure: the flush is behind, clients should retry later
+        resp = jsonify(error='Buffer full', buffered=e.args[0])
+        resp.headers['Retry-After'] = str(INGEST_FLUSH_INTERVAL)
+        return resp, 429
+
+    if buffered >= INGEST_FLUSH_ROWS:
+        flush.delay(organization_id)
+
+    resp = jsonify(accepted=len(rows), buffered=buffered)
+    resp.headers['X-Pipet-Buffered'] = str(buffered)
+    return resp, 202
+
+
+def payload(kind):
+    """
+    A single object or a list of objects of one kind.
+    """
+    return lambda: parse_payload(kind, request.get_json(silent=True))
 
 
 @blueprint.route('/identity', methods=['PUT'])
 def identity():
-    organization = Organization.query.filter_by(name=request.authorization.username,
-                                                api_key=request.authorization.password).first()
-    return
+    return ingest(payload('identity'))
 
 
 @blueprint.route('/group', methods=['PUT'])
 def group():
-    organization = Organization.query.filter_by(name=request.authorization.username,
-                                                api_key=request.authorization.password).first()
-    return
+    return ingest(payload('group'))
 
 
 @blueprint.route('/event', methods=['POST'])
 def event():
-    organization = Organization.query.filter_by(name=request.authorization.username,
-                                                api_key=request.authorization.password).first()
-    data = request.get_json()
-    process_event.delay(organization.id, data)
+    return ingest(payload('event'))
 
 
 @blueprint.route('/page', methods=['POST'])
 def page():
-    organization = Organization.query.filter_by(name=request.authorization.username,
-                                                api_key=request.authorization.password).first()
-    data = request.get_json()
-    process_event.delay(organization.id, data)
+    return ingest(payload('page'))
+
+
+@blueprint.route('/batch', methods=['POST'])
+def batch():
+    """
+    Objects of any kind, as `{"batch": [{"kind": "event", ...}, ...]}`.
+    """
+    return ingest(lambda: parse_batch(request.get_json(silent=True)))
+
+
+@blueprint.route('/buffer', methods=['GET'])
+def buffer_status():
+    organization_id = authenticate()
+    if not organization_id:
+        return jsonify(error='Unauthorized'), 401
+    sizes = buffer.sizes(organization_id)
+    return jsonify(buffered=sum(sizes.values()), kinds=sizes,
+                   max_buffered=buffer.max_buffered,
+                   dead_lettered=buffer.dead_lettered(organization_id))
@@ -1,8 +1,13 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, validators
+from wtforms import SelectMultipleField, StringField, validators, widgets
 from wtforms.fields.html5 import EmailField
 
 
+class MultiCheckboxField(SelectMultipleField):
+    widget = widgets.ListWidget(prefix_label=False)
+    option_widget = widgets.CheckboxInput()
+
+
 class LoginForm(FlaskForm):
     email = EmailField('Email', validators=[validators.DataRequired('Email required.'),
                                             validators.Email('You must enter a valid email.')])
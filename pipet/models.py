@@ -3,13 +3,15 @@ import uuid
 
 from flask import url_for
 from flask_login import UserMixin
-from sqlalchemy import Column, create_engine
+from sqlalchemy import Column, event
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.schema import DDL
 from sqlalchemy.types import Integer
 
 from pipet import app, db
-from pipet.sources import Base, SCHEMANAME
+from pipet.sources import APPEND_ONLY_MODELS, Base, SCHEMANAME
+from pipet.utils.engines import engines
+from pipet.utils.partitions import maintain_partitions
 
 
 class User(db.Model, UserMixin):
@@ -58,18 +60,31 @@ class Organization(db.Model):
                         nullable=False, default=uuid.uuid4)
 
     def create_session(self):
-        engine = create_engine(self.database_credentials, use_batch_mode=True)
-        session_factory = sessionmaker(bind=engine)
-        return scoped_session(session_factory)()
+        return engines.session(self.id, self.database_credentials)
 
     def create_all(self, session):
         session.bind.execute(
             DDL('CREATE SCHEMA IF NOT EXISTS {schema}'.format(schema=SCHEMANAME)))
         Base.metadata.create_all(session.bind)
+        self.maintain_partitions(session)
         self.initialized = True
 
+    def maintain_partitions(self, session):
+        """
+        Create upcoming partitions of the append-only tables and drop the
+        ones past retention. Run hourly by the `maintain_partitions` task.
+        """
+        return maintain_partitions(session.connection(),
+                                   [m.__table__ for m in APPEND_ONLY_MODELS])
+
     def drop_all(self, session):
         Base.metadata.drop_all(session.bind)
         session.bind.execute(
             DDL('DROP SCHEMA IF EXISTS {schema}'.format(schema=SCHEMANAME)))
         self.initialized = False
+
+
+@event.listens_for(Organization.database_credentials, 'set')
+def dispose_engine(target, value, oldvalue, initiator):
+    if target.id and value != oldvalue:
+        engines.dispose(target.id)
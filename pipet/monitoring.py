@@ -0,0 +1,118 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+from celery.signals import worker_process_init
+import click
+from flask import Response, abort, request
+
+from pipet import app, metrics
+from pipet.api.tasks import buffer
+from pipet.sources.stripe import tasks as stripe_tasks
+from pipet.sources.zendesk import tasks as zendesk_tasks
+from pipet.utils import http
+from pipet.utils.engines import engines
+
+
+# Seconds between publications of a worker process's own gauges
+PROCESS_GAUGES_INTERVAL = int(os.environ.get('PROCESS_GAUGES_INTERVAL', 15))
+
+logger = logging.getLogger(__name__)
+
+
+def gauges(now=None):
+    """
+    Gauges read from the sync schedules and the ingestion buffer at scrape
+    time, rather than recorded as things happen.
+
+    Return:
+        list: (name, labels, value) samples
+    """
+    now = now or time.time()
+    samples = []
+    for tasks in (stripe_tasks, zendesk_tasks):
+        schedule = tasks.schedule
+        for member, state in schedule.states().items():
+            account, _, resource = member.partition(':')
+            labels = {'source': schedule.name, 'account': account}
+            if resource:
+                labels['resource'] = resource
+            samples.append(('sync_lag_seconds', labels, now - state['caught_up']))
+            samples.append(('sync_interval_seconds', labels, state['interval']))
+
+    for organization_id in buffer.organizations():
+        for kind, size in buffer.sizes(organization_id).items():
+            samples.append(('ingest_buffered_rows',
+                            {'account': organization_id, 'resource': kind}, size))
+    return samples
+
+
+def process_gauges():
+    """
+    Gauges only the current process can read, of its warehouse engine pools
+    and its source API connection pools.
+
+    Return:
+        list: (name, labels, value) samples
+    """
+    samples = []
+    for organization_id, stats in engines.stats().items():
+        labels = {'account': organization_id}
+        for stat in ('size', 'checked_in', 'checked_out', 'overflow'):
+            samples.append(('warehouse_pool_' + stat, labels, stats[stat]))
+        samples.append(('warehouse_engine_idle_seconds', labels, stats['idle_seconds']))
+
+    # connections are reused for the requests beyond the connections opened
+    for name, stats in http.stats().items():
+        labels = {'source': name}
+        samples.append(('http_requests_total', labels, stats['requests']))
+        samples.append(('http_connections_total', labels, stats['connections']))
+    return samples
+
+
+def publish_process_gauges(interval=PROCESS_GAUGES_INTERVAL):
+    process = '{}:{}'.format(socket.gethostname(), os.getpid())
+    while True:
+        try:
+            metrics.publish(process, process_gauges(), ttl=3 * interval)
+        except Exception:
+            logger.exception('Publishing gauges of {} failed'.format(process))
+        time.sleep(interval)
+
+
+@worker_process_init.connect
+def start_publishing_process_gauges(**kwargs):
+    """
+    Every worker process publishes its own gauges from a background
+    thread, since the web and CLI processes can't see its pools.
+    """
+    threading.Thread(target=publish_process_gauges, name='publish-process-gauges',
+                     daemon=True).start()
+
+
+def render():
+    """
+    Return:
+        str: every metric in the Prometheus text format
+    """
+    return metrics.render(gauges())
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Prometheus scrape endpoint. Set METRICS_TOKEN to require it as a
+    bearer token.
+    """
+    token = os.environ.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != 'Bearer ' + token:
+        abort(401)
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.cli.command('metrics')
+def metrics_command():
+    """Show sync, API and ingestion metrics in the Prometheus text format"""
+    click.echo(render(), nl=False)
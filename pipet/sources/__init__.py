@@ -1,4 +1,6 @@
-from sqlalchemy import Column
+import os
+
+from sqlalchemy import Column, Index
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import as_declarative
 from sqlalchemy.schema import MetaData
@@ -8,6 +10,29 @@ from pipet.utils import PipetBase
 
 
 SCHEMANAME = 'pipet'
+# 'day' or 'month'
+PARTITION_INTERVAL = os.environ.get('PARTITION_INTERVAL', 'day')
+# Days of events and page views kept, 0 keeps them forever
+EVENT_RETENTION_DAYS = int(os.environ.get('EVENT_RETENTION_DAYS', 0))
+PAGE_RETENTION_DAYS = int(os.environ.get('PAGE_RETENTION_DAYS', 0))
+
+
+def append_only(table_name, retention_days):
+    """
+    Table arguments for append-only tables, range partitioned on `created`
+    and maintained by `pipet.utils.partitions`. They have no primary key or
+    unique index, so rows are written with plain COPY and no conflict
+    checks; duplicates resent by clients are left for queries to handle.
+    """
+    return (
+        # BRIN indexes stay tiny on insert-ordered data
+        Index('ix_{}_created'.format(table_name), 'created', postgresql_using='brin'),
+        {
+            'postgresql_partition_by': 'RANGE (created)',
+            'info': {'partition_interval': PARTITION_INTERVAL,
+                     'retention_days': retention_days},
+        },
+    )
 
 
 @as_declarative(metadata=MetaData(schema=SCHEMANAME))
@@ -25,25 +50,33 @@ class Identity(Base):
 
 
 class Event(Base):
-    uuid = Column(Text, primary_key=True)
-    created = Column(DateTime)
+    uuid = Column(Text, nullable=False)
+    created = Column(DateTime, nullable=False)
     type = Column(Text)
     data = Column(JSONB)
 
+    __table_args__ = append_only('events', EVENT_RETENTION_DAYS)
+    # Only the mapper needs a primary key
+    __mapper_args__ = {'primary_key': [uuid, created]}
+
 
 class Page(Base):
-    """
-    No anonymous visitor should be able to visit more than once a second
-    """
-    created = Column(DateTime, primary_key=True)
-    url = Column(Text, primary_key=True)
-    anonymous_id = Column(Text, primary_key=True)
+    created = Column(DateTime, nullable=False)
+    url = Column(Text, nullable=False)
+    anonymous_id = Column(Text, nullable=False)
     referrer = Column(Text)
     ip_address = Column(Text)
     user_id = Column(Text)
     session_id = Column(Text)
     data = Column(Text)
 
+    __table_args__ = append_only('pages', PAGE_RETENTION_DAYS)
+    __mapper_args__ = {'primary_key': [created, url, anonymous_id]}
+
+
+# Tables written through the append-only path
+APPEND_ONLY_MODELS = (Event, Page)
+
 
 class Group(Base):
     created = Column(DateTime)
@@ -1,34 +1,68 @@
-from inspect import isclass
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
+import queue
 
-import requests
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.schema import DDL
 
+from pipet import metrics, redis_client
 from pipet.models import db
+from pipet.utils import UpsertBatch
+from pipet.utils.bulk import BULK_LOAD_ROWS
+from pipet.utils.http import HTTP_TIMEOUT, get_session
+from pipet.utils.ratelimit import RequestScheduler
+from pipet.utils.syncconfig import SyncConfig
 from pipet.sources.stripe.models import (
+    BACKFILL_MODELS,
     Base,
-    CLASS_REGISTRY,
     EmptyResponse,
+    OBJECT_TYPE_INDEX,
     SCHEMANAME,
     STRIPE_API_VERSION,
+    collect_remaining_children,
+    migrate,
+    raw_metadata,
 )
 
 
+# Commit after this many events instead of after every page of events
+UPDATE_COMMIT_EVERY = int(os.environ.get('STRIPE_UPDATE_COMMIT_EVERY', 0)) or None
+# Number of classes backfilled concurrently
+BACKFILL_WORKERS = int(os.environ.get('STRIPE_BACKFILL_WORKERS', 4))
+# Requests per second allowed for a single account, shared by all workers
+REQUESTS_PER_SECOND = float(os.environ.get('STRIPE_REQUESTS_PER_SECOND', 20))
+# Requests per second allowed across all accounts, unlimited if unset
+SOURCE_REQUESTS_PER_SECOND = float(
+    os.environ.get('STRIPE_SOURCE_REQUESTS_PER_SECOND', 0)) or None
+# Accounts with webhooks are only polled to reconcile missed events
+RECONCILE_INTERVAL = int(os.environ.get('STRIPE_RECONCILE_INTERVAL', 60 * 60))
+
+scheduler = RequestScheduler(SCHEMANAME, REQUESTS_PER_SECOND,
+                             source_rate=SOURCE_REQUESTS_PER_SECOND, redis=redis_client,
+                             metrics=metrics)
+
+
 def get_class_for_object_type(object_type):
     try:
-        return [m for n, m in CLASS_REGISTRY.items() if isclass(m) and issubclass(m, Base) and object_type == m.object_type()][0]
-    except IndexError:
+        return OBJECT_TYPE_INDEX[object_type]
+    except KeyError:
         raise ValueError(
             'No matching class found for object %s ' % object_type)
 
 
 class StripeAccount(db.Model):
     api_key = db.Column(db.Text)
+    # signing secret of the account's webhook endpoint, if it has one
+    webhook_secret = db.Column(db.Text)
     initialized = db.Column(db.Boolean)
     backfilled = db.Column(db.Boolean)
     event_id = db.Column(db.Text)
+    # backfill cursors by tablename, {'cursor': str, 'done': bool}
+    cursors = db.Column(JSON, default=lambda: {})
+    # tables and columns synced, see `SyncConfig`
+    sync_config = db.Column(JSON)
 
     organization_id = db.Column(db.Integer, db.ForeignKey('organization.id'))
 
@@ -39,115 +73,238 @@ class StripeAccount(db.Model):
     def auth(self):
         return self.api_key, None
 
+    @property
+    def selection(self):
+        return SyncConfig(self.sync_config)
+
+    def set_sync_config(self, config):
+        """
+        Change the synced tables. Events of disabled tables were skipped, so
+        classes with a table enabled again are backfilled again from the
+        start, as are classes enabled after the backfill finished.
+        """
+        previous = self.selection
+        self.sync_config = config
+        selection = self.selection
+        cursors = dict(self.cursors or {})
+        for m in BACKFILL_MODELS:
+            if any(selection.enabled(t) and not previous.enabled(t) for t in m.table_names()):
+                cursors.pop(m.__tablename__, None)
+        self.cursors = cursors
+        if self.backfilled and any(not cursors.get(m.__tablename__, {}).get('done')
+                                   for m in selection.models(BACKFILL_MODELS)):
+            self.backfilled = False
+
     def get(self, path, **kwargs):
-        kwargs['headers'] = kwargs.get('headers', {}).update(
-            {'Stripe-Version': STRIPE_API_VERSION})
+        kwargs['headers'] = kwargs.get('headers') or {}
+        kwargs['headers']['Stripe-Version'] = STRIPE_API_VERSION
         kwargs['auth'] = self.auth
         kwargs['params'] = kwargs.get('params', {})
         kwargs['params']['limit'] = kwargs['params'].get('limit', 100)
-        return requests.get('https://api.stripe.com' + path, **kwargs)
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        session = get_session(SCHEMANAME, pool_maxsize=BACKFILL_WORKERS)
+        return scheduler.request(self.id, lambda: session.get(
+            'https://api.stripe.com' + path, **kwargs))
 
     def create_all(self, session):
         session.bind.execute(
             DDL('CREATE SCHEMA IF NOT EXISTS {schema}'.format(schema=SCHEMANAME)))
         Base.metadata.create_all(session.bind)
+        migrate(session.bind)
         self.initialized = True
 
     def drop_all(self, session):
+        raw_metadata.drop_all(session.bind)
         Base.metadata.drop_all(session.bind)
         session.bind.execute(
             DDL('DROP SCHEMA IF EXISTS {schema}'.format(schema=SCHEMANAME)))
         self.initialized = False
 
-    def update(self, event_id=None):
+    def update(self, event_id=None, commit_every=UPDATE_COMMIT_EVERY, heartbeat=None):
         """
         All Stripe models have an `object_type` attribute
         For each event in the response, find the model from the `object` within the `data` attribute,
         and based on the `object` type, upsert the object.
+        Events are collected oldest first, so the newest version of an object wins.
+
+        Every event is listed, since Stripe's `types[]` filter only takes
+        exact event names, and those of unsynced classes are skipped.
+
+        Events are written as they arrive: every page, or every `commit_every`
+        events, is committed and `event_id` checkpointed, so memory stays flat
+        and an interrupted update resumes from the last committed event.
+        `heartbeat` is called after every page.
+
+        Return:
+            int: number of rows written
         """
         logging.info('Starting update for <StripeAccount {}>'.format(self.id))
         event_id = event_id or self.event_id
 
-        statements = []
+        batch = UpsertBatch()
+        pending = rows = 0
+        selection = self.selection
         session = self.organization.create_session()
 
-        while True:
-            conn = session.connection()
-            resp = self.get('/v1/events',
-                            params={'ending_before': event_id})
-            resp.raise_for_status()
-            data = resp.json()['data']
+        try:
+            while True:
+                resp = self.get('/v1/events', params={'ending_before': event_id})
+                resp.raise_for_status()
+                page = resp.json()
+                metrics.record_page(len(page['data']), source=SCHEMANAME,
+                                    account=self.id, resource='events')
 
-            for event_object in [d['data']['object'] for d in data]:
-                try:
-                    cls = get_class_for_object_type(event_object['object'])
-                except ValueError:
-                    continue
-                statements.append(cls.upsert(cls.parse(event_object)))
+                for event in reversed(page['data']):
+                    event_object = event['data']['object']
+                    try:
+                        cls = get_class_for_object_type(event_object['object'])
+                    except ValueError:
+                        cls = None
+                    if cls and selection.enabled(cls.__tablename__):
+                        collect_remaining_children(
+                            self, batch, cls.collect(batch, event_object))
+
+                    event_id = event['id']
+                    pending += 1
+                    if commit_every and pending >= commit_every:
+                        rows += self.checkpoint(session, batch, event_id)
+                        pending = 0
+
+                if pending and not commit_every:
+                    rows += self.checkpoint(session, batch, event_id)
+                    pending = 0
 
-            if len(data):
-                event_id = data[0]['id']
-            else:
-                break
+                if heartbeat:
+                    heartbeat()
+                if not page['data'] or not page['has_more']:
+                    break
+
+            if pending:
+                rows += self.checkpoint(session, batch, event_id)
+        finally:
+            session.close()
+        return rows
 
-            if not resp.json()['has_more']:
-                break
+    def checkpoint(self, session, batch, event_id):
+        """
+        Write `batch` to the warehouse, then record `event_id` as the
+        last applied event.
 
-        for statement in statements:
-            conn.execute(statement)
+        Return:
+            int: number of rows written
+        """
+        written = metrics.write_batch(self.selection.apply(batch), session.connection(),
+                                      source=SCHEMANAME, account=self.id)
         session.commit()
 
         self.event_id = event_id
         db.session.add(self)
         db.session.commit()
+        return sum(written.values())
 
-    def backfill(self):
+    def backfill(self, workers=None, heartbeat=None):
         """
         TODO https://www.ehfeng.com/mirroring-stripe/
+
+        Each class with an endpoint is backfilled as its own stream on a
+        pool of `workers` threads, sharing the account's request budget.
+        Every stream checkpoints its cursor in `cursors` after each commit,
+        so an interrupted backfill resumes each class where it stopped.
+        `heartbeat` is called every second while the backfill runs.
+
+        Return:
+            int: number of rows written, including the catch-up `update`
         """
         logging.info(
             'Starting backfill for <StripeAccount {}>'.format(self.id))
 
-        # Get latests event_id. Iterating is faster than allowing the
-        # update function to attempt to upsert.
-        event_id = None
-        while True:
-            resp = self.get('/v1/events',
-                            params={'starting_after': event_id})
-
-            if resp.json()['data']:
-                event_id = resp.json()['data'][-1]['id']
-            else:
-                break
+        if not self.event_id:
+            # Events are listed newest first, so the first one is the
+            # watermark update catches up from once the backfill is done.
+            resp = self.get('/v1/events', params={'limit': 1})
+            resp.raise_for_status()
+            data = resp.json()['data']
 
-            if not resp.json()['has_more']:
-                break
+            self.event_id = data[0]['id'] if data else None
+            db.session.add(self)
+            db.session.commit()
 
         # Start Backfill
-        session = self.organization.create_session()
+        cursors = dict(self.cursors or {})
+        classes = [m for m in self.selection.models(BACKFILL_MODELS)
+                   if not cursors.get(m.__tablename__, {}).get('done')]
+        progress = queue.Queue()
+
+        with ThreadPoolExecutor(max_workers=workers or BACKFILL_WORKERS) as executor:
+            futures = [executor.submit(self.backfill_class, cls,
+                                       self.organization.create_session(),
+                                       cursors.get(cls.__tablename__, {}).get('cursor'), progress)
+                       for cls in classes]
 
-        for cls in [m for n, m in CLASS_REGISTRY.items() if isclass(m) and issubclass(m, Base) and m.endpoint]:
-            # TODO Make these parallel to speed up execution
-            logging.info('Backfilling for <StripeAccount {}>, class {}'.format(
-                self.id, cls.__name__))
-            cursor = None
+            # Only this thread writes to the app database. Checkpoints bypass
+            # the ORM session so the account isn't expired under the workers.
             while True:
-                conn = session.connection()
+                if heartbeat:
+                    heartbeat()
                 try:
-                    statements, cursor, has_more = cls.sync(self, cursor)
+                    name, state = progress.get(timeout=1)
+                except queue.Empty:
+                    if all(f.done() for f in futures):
+                        break
+                    continue
+                cursors[name] = state
+                db.engine.execute(StripeAccount.__table__.update().where(
+                    StripeAccount.id == self.id).values(cursors=cursors))
+
+            rows = sum(future.result() for future in futures)
+
+        self.cursors = cursors
+        self.backfilled = True
+        db.session.add(self)
+        db.session.commit()
+
+        return rows + self.update(heartbeat=heartbeat)
+
+    def backfill_class(self, cls, session, cursor, progress):
+        """
+        Backfill a single class, reporting `(tablename, state)` to the
+        `progress` queue after every commit. Tables are being filled for
+        the first time, so pages are buffered up to `BULK_LOAD_ROWS` rows
+        and bulk loaded with COPY.
+
+        Return:
+            int: number of rows written
+        """
+        logging.info('Backfilling for <StripeAccount {}>, class {}'.format(
+            self.id, cls.__name__))
+        pending = UpsertBatch()
+        selection = self.selection
+        rows = 0
+        try:
+            while True:
+                try:
+                    batch, cursor, has_more = cls.sync(self, cursor)
                 except EmptyResponse:
                     break
 
-                for statement in statements:
-                    conn.execute(statement)
-
-                session.commit()
+                metrics.record_page(len(batch), source=SCHEMANAME, account=self.id,
+                                    resource=cls.__tablename__)
+                pending.extend(selection.apply(batch))
+                if len(pending) >= BULK_LOAD_ROWS:
+                    rows += len(pending)
+                    metrics.write_batch(pending, session.connection(), bulk=True,
+                                        source=SCHEMANAME, account=self.id)
+                    session.commit()
+                    progress.put((cls.__tablename__, {'cursor': cursor, 'done': False}))
 
                 if not has_more:
                     break
 
-        self.backfilled = True
-        db.session.add(self)
-        db.session.commit()
-
-        self.update(event_id)
+            rows += len(pending)
+            metrics.write_batch(pending, session.connection(), bulk=True,
+                                source=SCHEMANAME, account=self.id)
+            session.commit()
+            progress.put((cls.__tablename__, {'cursor': cursor, 'done': True}))
+        finally:
+            session.close()
+        return rows
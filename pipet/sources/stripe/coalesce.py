@@ -0,0 +1,133 @@
+import json
+import os
+
+from pipet.sources.stripe import get_class_for_object_type
+from pipet.sources.stripe.models import collect_remaining_children
+from pipet.utils import UpsertBatch
+
+
+# Seconds webhook events are held so repeated updates to an object are
+# written once
+WEBHOOK_COALESCE_WINDOW = int(os.environ.get('STRIPE_WEBHOOK_COALESCE_WINDOW', 5))
+# Seconds the version of a written object is remembered, Stripe retries
+# undelivered webhooks for 3 days
+WEBHOOK_WRITTEN_TTL = int(os.environ.get('STRIPE_WEBHOOK_WRITTEN_TTL', 3 * 24 * 60 * 60))
+# Seconds a flush may hold the account's flush lock
+WEBHOOK_FLUSH_TIMEOUT = int(os.environ.get('STRIPE_WEBHOOK_FLUSH_TIMEOUT', 10 * 60))
+
+
+# Keeps an object only if it's at least as new as the one already pending
+# and the one last written, since Stripe doesn't deliver webhooks in order.
+COALESCE_SCRIPT = """
+local written = redis.call('GET', KEYS[3])
+if written and tonumber(written) > tonumber(ARGV[2]) then
+    return 0
+end
+local current = redis.call('HGET', KEYS[2], ARGV[1])
+if current and tonumber(current) > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+return 1
+"""
+
+
+class Coalescer():
+    """
+    Pending webhook objects for an account, in Redis hashes keyed by
+    `object:id`, so however many events an object gets within the window,
+    only its newest version is written.
+
+    Versions are compared by event time. The version written last is
+    remembered for `WEBHOOK_WRITTEN_TTL`, so an older one delivered late is
+    dropped instead of overwriting it. Flushes of an account hold its
+    `lock`, so they commit in order.
+    """
+
+    def __init__(self, redis, account_id):
+        self.redis = redis
+        self.account_id = account_id
+        self.objects_key = 'stripe:webhooks:{}:objects'.format(account_id)
+        self.created_key = 'stripe:webhooks:{}:created'.format(account_id)
+        self.scheduled_key = 'stripe:webhooks:{}:scheduled'.format(account_id)
+        self.lock_key = 'stripe:webhooks:{}:flush'.format(account_id)
+        self._script = redis.register_script(COALESCE_SCRIPT)
+
+    def add(self, data, created):
+        """
+        Args:
+            data (dict): API object from the event
+            created (int): event timestamp
+        Return:
+            bool: whether the object replaced a pending one or was added
+        """
+        key = '{}:{}'.format(data['object'], data['id'])
+        return bool(self._script(keys=[self.objects_key, self.created_key, self.written_key(key)],
+                                 args=[key, created, json.dumps(data)]))
+
+    def written_key(self, key):
+        return 'stripe:webhooks:{}:written:{}'.format(self.account_id, key)
+
+    def lock(self, timeout=WEBHOOK_FLUSH_TIMEOUT):
+        return self.redis.lock(self.lock_key, timeout=timeout)
+
+    def schedule(self, window=WEBHOOK_COALESCE_WINDOW):
+        """
+        Return:
+            bool: True if the caller should schedule a flush, i.e. one isn't
+                already scheduled for this window
+        """
+        return bool(self.redis.set(self.scheduled_key, 1, nx=True, ex=window))
+
+    def drain(self):
+        """
+        Atomically take every pending object.
+
+        Return:
+            list: (created, data) tuples, oldest first
+        """
+        self.redis.delete(self.scheduled_key)
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self.objects_key)
+        pipe.hgetall(self.created_key)
+        pipe.delete(self.objects_key, self.created_key)
+        objects, created, _ = pipe.execute()
+        return sorted(((int(created[k]), json.loads(v)) for k, v in objects.items()),
+                      key=lambda pair: pair[0])
+
+    def written(self, objects, ttl=WEBHOOK_WRITTEN_TTL):
+        """
+        Remember the versions of drained objects once they're committed.
+        """
+        pipe = self.redis.pipeline()
+        for created, data in objects:
+            pipe.setex(self.written_key('{}:{}'.format(data['object'], data['id'])),
+                       ttl, created)
+        pipe.execute()
+
+    def restore(self, objects):
+        """
+        Put drained objects back after a failed write, unless newer versions
+        have arrived since.
+        """
+        for created, data in objects:
+            self.add(data, created)
+
+
+def collect(objects, account):
+    """
+    Args:
+        objects (list): (created, data) tuples
+        account (StripeAccount): to fetch the rest of embedded child lists
+    Return:
+        UpsertBatch: rows for the objects Pipet has a model for
+    """
+    batch = UpsertBatch()
+    for _, data in objects:
+        try:
+            cls = get_class_for_object_type(data['object'])
+        except ValueError:
+            continue
+        collect_remaining_children(account, batch, cls.collect(batch, data))
+    return batch
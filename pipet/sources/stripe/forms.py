@@ -1,7 +1,16 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, validators
+from wtforms import StringField, TextAreaField, validators
 from wtforms.fields.html5 import EmailField
 
+from pipet.forms import MultiCheckboxField
+
 
 class CreateAccountForm(FlaskForm):
     api_key = StringField('API Key', validators=[validators.DataRequired()])
+    webhook_secret = StringField('Webhook Signing Secret', validators=[
+                                 validators.Optional()])
+    tables = MultiCheckboxField('Tables', validators=[
+                                validators.DataRequired()])
+    columns = TextAreaField('Columns', description=(
+                            'One table per line, as `table: column, column`, '
+                            'to only sync those columns'))
@@ -1,28 +1,41 @@
+from collections import namedtuple
 from datetime import datetime
+from inspect import isclass
 
 from flask_sqlalchemy import camel_to_snake_case
-from requests.exceptions import HTTPError
-from sqlalchemy import Column, Table
+from sqlalchemy import Column, Table, text
 from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.ext.declarative import as_declarative, declared_attr
 from sqlalchemy.orm import relationship
 from sqlalchemy.schema import MetaData, ForeignKey
 from sqlalchemy.types import Boolean, Float, Text, BigInteger, DateTime
 import stripe
 
-from pipet.utils import PipetBase
+from pipet.utils import PipetBase, UpsertBatch
+from pipet.utils.checkpoint import checkpoint_table
+from pipet.utils.raw import elements, insert_from, json_expression, raw_table, upsert_from
 
 
 STRIPE_API_VERSION = '2018-02-28'
 SCHEMANAME = 'stripe'
 CLASS_REGISTRY = {}
 metadata = MetaData(schema=SCHEMANAME)
+# raw landing tables, only created when raw landing is on
+raw_metadata = MetaData(schema=SCHEMANAME)
 
 
 class EmptyResponse(Exception):
     pass
 
 
+# A list embedded in a parent object, e.g. a subscription's `items`, of
+# `model` (a class name, like relationship targets). Stripe embeds the first
+# page of it; `endpoint` lists the rest, with the parent's id in the path
+# or, given `parent_param`, in the query.
+Child = namedtuple('Child', ['field', 'model', 'parent_column', 'endpoint', 'parent_param'])
+
+
 @as_declarative(metadata=metadata, class_registry=CLASS_REGISTRY)
 class Base(PipetBase):
     id = Column(Text, primary_key=True)
@@ -32,9 +45,9 @@ class Base(PipetBase):
         return camel_to_snake_case(cls.__name__)
 
     @classmethod
-    def parse(cls, data):
-        d = {}
-        for field, column in cls.__table__._columns.items():
+    def compile_parse_plan(cls):
+        plan = []
+        for field, column in cls.__table__.columns.items():
             # metadata is not a valid column name
             if field == 'meta':
                 data_field = 'metadata'
@@ -42,15 +55,43 @@ class Base(PipetBase):
                 data_field = field[:-3]
             else:
                 data_field = field
-            value = data.get(data_field, None)
-            if not value or not isinstance(column, Column):
+            # We assume GMT
+            convert = datetime.fromtimestamp if isinstance(
+                column.type, DateTime) else None
+            plan.append((data_field, field, convert))
+        return plan
+
+    @classmethod
+    def materialize_expression(cls, data_field, column, convert, payload='raw.payload'):
+        if isinstance(column.type, DateTime):
+            # We assume GMT
+            return "to_timestamp(CAST({}->>'{}' AS double precision)) AT TIME ZONE 'UTC'".format(
+                payload, data_field)
+        if data_field != column.key and column.key.endswith('_id'):
+            # references may be expanded into the object they refer to
+            return "COALESCE({0}->'{1}'->>'id', {0}->>'{1}')".format(payload, data_field)
+        return json_expression(column, data_field, payload)
+
+    @classmethod
+    def materialize(cls, conn, source, params, selection=None):
+        """
+        Also upsert the children embedded in the objects. Pages of children
+        Stripe cut short are fetched when the parent lands, see `collect`.
+        """
+        written = upsert_from(conn, cls.__table__, cls.materialize_columns(selection),
+                              source, params)
+        for child in cls.children:
+            model = CLASS_REGISTRY[child.model]
+            if selection and not selection.enabled(model.__tablename__):
                 continue
-            elif isinstance(column.type, DateTime):
-                # We assume GMT
-                d[field] = datetime.fromtimestamp(value)
-            else:
-                d[field] = value
-        return d
+            columns = [(k, e) for k, e in model.materialize_columns(selection, 'child.payload')
+                       if k != child.parent_column]
+            columns.append((child.parent_column, "raw.payload->>'id'"))
+            written.update(upsert_from(
+                conn, model.__table__, columns,
+                '{} CROSS JOIN LATERAL {} AS child(payload)'.format(
+                    source, elements("raw.payload->'{}'->'data'".format(child.field))), params))
+        return written
 
     @classmethod
     def sync(cls, account, cursor):
@@ -66,39 +107,89 @@ class Base(PipetBase):
 
         Returns
         -------
-        (list, str, bool)
-            a tuple which is a list of statements, cursor, and
+        (UpsertBatch, str, bool)
+            a tuple which is a batch of rows to write, cursor, and
             a bool of whether there are more
         """
         params = {'starting_after': cursor}
 
         resp = account.get(cls.endpoint, params=params)
+        resp.raise_for_status()
+        page = resp.json()
 
-        try:
-            resp.raise_for_status()
-        except HTTPError:
-            if resp.status_code == 429:
-                raise EmptyResponse
-            raise HTTPError
-
-        has_more = resp.json()['has_more']
-        data = resp.json()['data']
-
-        if data:
-            cursor = data[-1]['id']
+        if page['data']:
+            cursor = page['data'][-1]['id']
         else:
             raise EmptyResponse
 
-        return cls.process_response(resp), cursor, has_more
+        return cls.process_response(page, account), cursor, page['has_more']
+
+    @classmethod
+    def process_response(cls, page, account=None):
+        """
+        Args:
+            page (dict): decoded list response
+            account (StripeAccount): to fetch the rest of embedded child
+                lists with more pages, which are otherwise left out
+        Return:
+            UpsertBatch
+        """
+        batch = UpsertBatch()
+
+        truncated = []
+        for data in page['data']:
+            truncated += cls.collect(batch, data)
+
+        if account:
+            collect_remaining_children(account, batch, truncated)
+        return batch
+
+    # embedded child lists, see `Child`
+    children = ()
 
     @classmethod
-    def process_response(cls, response):
-        statements = []
+    def table_names(cls):
+        """
+        Return:
+            list: names of the tables filled by syncing this class, its own
+                and its children's
+        """
+        return [cls.__tablename__] + [CLASS_REGISTRY[c.model].__tablename__
+                                      for c in cls.children]
 
-        for data in response.json()['data']:
-            statements.append(cls.upsert(cls.parse(data)))
+    @classmethod
+    def collect(cls, batch, data):
+        """
+        Add the rows for a single API object and its embedded children to
+        `batch`. Children are read from the embedded lists rather than
+        fetched per object.
+
+        When landing raw, the object is landed as is and its embedded children
+        are left for `materialize`.
 
-        return statements
+        Return:
+            list: (Child, parent id, last child id) for embedded lists with
+                more pages, to be fetched with `collect_remaining_children`
+        """
+        landed = cls.lands_raw()
+        if landed:
+            batch.land(cls.__table__, data)
+        else:
+            batch.upsert(cls, cls.parse(data))
+
+        truncated = []
+        for child in cls.children:
+            embedded = data.get(child.field)
+            if not embedded:
+                continue
+            model = CLASS_REGISTRY[child.model]
+            for child_data in embedded['data'] if not landed else ():
+                row = model.parse(child_data)
+                row[child.parent_column] = data['id']
+                batch.upsert(model, row)
+            if embedded.get('has_more') and embedded['data']:
+                truncated.append((child, data['id'], embedded['data'][-1]['id']))
+        return truncated
 
 ##################
 # CORE RESOURCES #
@@ -118,8 +209,9 @@ class BalanceTransaction(Base):
     status = Column(Text)
     type = Column(Text)
 
+    # replaced as a whole for every transaction synced
     fee_details = Table('balance_transaction_fee_details', metadata,
-                        Column('balance_transaction_id', Text),
+                        Column('balance_transaction_id', Text, index=True),
                         Column('amount', BigInteger),
                         Column('application', Text),
                         Column('currency', Text),
@@ -131,16 +223,34 @@ class BalanceTransaction(Base):
     event_types = ('balance.available', )
 
     @classmethod
-    def process_response(cls, response):
-        statements = []
+    def table_names(cls):
+        return super(BalanceTransaction, cls).table_names() + [cls.fee_details.name]
 
-        for data in response.json()['data']:
-            statements.append(cls.upsert(cls.parse(data)))
-            if data['fee_details']:
-                statements.append(cls.fee_details.insert().values(
-                    data['fee_details']))
+    @classmethod
+    def collect(cls, batch, data):
+        truncated = super(BalanceTransaction, cls).collect(batch, data)
+        if not cls.lands_raw():
+            batch.replace_children(cls.fee_details, 'balance_transaction_id',
+                                   data['id'], data.get('fee_details') or [])
+        return truncated
 
-        return statements
+    @classmethod
+    def materialize(cls, conn, source, params, selection=None):
+        written = super(BalanceTransaction, cls).materialize(conn, source, params, selection)
+        table = cls.fee_details
+        if selection and not selection.enabled(table.name):
+            return written
+
+        conn.execute(text('DELETE FROM {} WHERE balance_transaction_id IN (SELECT raw.id FROM {})'.format(
+            conn.dialect.identifier_preparer.format_table(table), source)), **params)
+        columns = [(k, json_expression(table.c[k], k, 'fee.payload'))
+                   for k in table.columns.keys() if k != 'balance_transaction_id']
+        columns.append(('balance_transaction_id', 'raw.id'))
+        written.update(insert_from(
+            conn, table, columns,
+            '{} CROSS JOIN LATERAL {} AS fee(payload)'.format(
+                source, elements("raw.payload->'fee_details'")), params))
+        return written
 
 
 class Charge(Base):
@@ -179,6 +289,7 @@ class Charge(Base):
 
     endpoint = '/v1/charges'
     event_types = ('charge', )
+    children = (Child('refunds', 'Refund', 'charge_id', '/v1/charges/{id}/refunds', None), )
 
 
 class Customer(Base):
@@ -359,17 +470,7 @@ class Invoice(Base):
     endpoint = '/v1/invoices'
     event_types = ('invoice', )
 
-    @classmethod
-    def process_response(cls, response):
-        statements = []
-
-        for data in response.json()['data']:
-            statements.append(cls.upsert(cls.parse(data)))
-
-            for line_data in data['lines']['data']:
-                statements.append(cls.upsert(cls.parse(line_data)))
-
-        return statements
+    children = (Child('lines', 'InvoiceLineItem', 'invoice_id', '/v1/invoices/{id}/lines', None), )
 
 
 class InvoiceItem(Base):
@@ -392,12 +493,19 @@ class InvoiceItem(Base):
     endpoint = '/v1/invoiceitems'
     event_types = ('invoiceitem', )
 
+    @classmethod
+    def object_type(cls):
+        return 'invoiceitem'
+
 
 class InvoiceLineItem(Base):
     amount = Column(BigInteger)
     currency = Column(Text)
     description = Column(Text)
     discountable = Column(Text)
+    # Subscription lines are identified by the subscription's id, which
+    # repeats across invoices
+    invoice_id = Column(Text, primary_key=True)
     invoice_item_id = Column(Text)
     meta = Column(JSONB, name='metadata')
     period = Column(JSONB)
@@ -411,6 +519,10 @@ class InvoiceLineItem(Base):
     endpoint = None
     event_types = (None, )
 
+    @classmethod
+    def object_type(cls):
+        return 'line_item'
+
 
 class Product(Base):
     active = Column(Boolean)
@@ -478,26 +590,8 @@ class Subscription(Base):
     endpoint = '/v1/subscriptions'
     event_types = ('customer.subscription', )
 
-    @classmethod
-    def process_response(cls, response):
-        statements = []
-
-        for data in response.json()['data']:
-            statements.append(cls.upsert(cls.parse(data)))
-
-            resp = account.get(SubscriptionItem.endpoint,
-                               params={'subscription': data['id']})
-
-            si_cursor = None
-            while True:
-                si_statements, si_cursor, has_more = SubscriptionItem.sync_for_subscription(
-                    account, cursor, si_cursor)
-                statements += si_statements
-
-                if not has_more:
-                    break
-
-        return statements
+    children = (Child('items', 'SubscriptionItem', 'subscription_id',
+                      '/v1/subscription_items', 'subscription'), )
 
 
 class SubscriptionItem(Base):
@@ -506,31 +600,10 @@ class SubscriptionItem(Base):
     quantity = Column(BigInteger)
     subscription_id = Column(Text)
 
-    endpoint = '/v1/subscription_items'
+    # collected from subscriptions
+    endpoint = None
     event_types = (None, )
 
-    @classmethod
-    def sync(cls, account, cursor):
-        return [], None, False
-
-    @classmethod
-    def sync_for_subscription(cls, account, subscription_id, cursor):
-        statements = []
-        resp = account.get(cls.endpoint, params={
-                           'starting_after': cursor, 'subscription': subscription_id})
-
-        try:
-            resp.raise_for_status()
-        except HTTPError:
-            if resp.status_code == 429:
-                return statements, cursor, False
-            raise HTTPError
-
-        ns, cursor = cls.process_response(resp)
-        statements += ns
-
-        return statements, cursor, resp.json()['has_more']
-
 ###########
 # CONNECT #
 ###########
@@ -553,6 +626,8 @@ class Transfer(Base):
 
     endpoint = '/v1/transfers'
     event_types = ('transfer', )
+    children = (Child('reversals', 'TransferReversal', 'transfer_id',
+                      '/v1/transfers/{id}/reversals', None), )
 
 
 class TransferReversal(Base):
@@ -635,3 +710,99 @@ class SKU(Base):
 
     endpoint = '/v1/skus'
     event_types = ('sku', )
+
+    @classmethod
+    def object_type(cls):
+        return 'sku'
+
+
+def collect_remaining_children(account, batch, truncated):
+    """
+    Page through the child lists Stripe cut short, adding them to `batch`.
+    Only lists with `has_more` cost requests, instead of a list request for
+    every parent, and only for child classes the account syncs.
+
+    Args:
+        account (StripeAccount):
+        batch (UpsertBatch):
+        truncated (list): as returned by `Base.collect`
+    """
+    for child, parent_id, cursor in truncated:
+        model = CLASS_REGISTRY[child.model]
+        if not account.selection.enabled(model.__tablename__):
+            continue
+        params = {child.parent_param: parent_id} if child.parent_param else {}
+        endpoint = child.endpoint.format(id=parent_id)
+        while True:
+            params['starting_after'] = cursor
+            resp = account.get(endpoint, params=params)
+            resp.raise_for_status()
+            page = resp.json()
+
+            for data in page['data']:
+                row = model.parse(data)
+                row[child.parent_column] = parent_id
+                batch.upsert(model, row)
+
+            if not page['data'] or not page['has_more']:
+                break
+            cursor = page['data'][-1]['id']
+
+
+##################
+# DISPATCH INDEX #
+##################
+
+# Built once at import time so routing an event is a dict lookup
+MODELS = tuple(m for m in CLASS_REGISTRY.values()
+               if isclass(m) and issubclass(m, Base))
+# classes with a list endpoint, in backfill order
+BACKFILL_MODELS = tuple(m for m in MODELS if m.endpoint)
+# Stripe `object` string to model class
+OBJECT_TYPE_INDEX = {m.object_type(): m for m in MODELS}
+
+for m in MODELS:
+    m.parse_plan()
+    raw_table(m.__table__, raw_metadata)
+
+checkpoints = checkpoint_table(metadata)
+
+
+def migrate(conn):
+    """
+    Bring tables created by earlier versions up to date, since `create_all`
+    leaves existing tables alone. Safe to run on every sync.
+    """
+    inspector = Inspector.from_engine(conn)
+    preparer = conn.dialect.identifier_preparer
+    existing = set(inspector.get_table_names(schema=SCHEMANAME))
+
+    # Invoice lines are keyed by (id, invoice_id)
+    table = InvoiceLineItem.__table__
+    if table.name in existing:
+        name = preparer.format_table(table)
+        if 'invoice_id' not in [c['name'] for c in inspector.get_columns(table.name, schema=SCHEMANAME)]:
+            conn.execute(text('ALTER TABLE {} ADD COLUMN invoice_id TEXT'.format(name)))
+        primary_key = inspector.get_pk_constraint(table.name, schema=SCHEMANAME)
+        if set(primary_key['constrained_columns']) != set(c.name for c in table.primary_key.columns):
+            # Lines without an invoice can't be keyed. Earlier versions
+            # upserted lines as invoices, so there shouldn't be any.
+            conn.execute(text('DELETE FROM {} WHERE invoice_id IS NULL'.format(name)))
+            if primary_key.get('name'):
+                conn.execute(text('ALTER TABLE {} DROP CONSTRAINT {}'.format(
+                    name, preparer.quote(primary_key['name']))))
+            conn.execute(text('ALTER TABLE {} ADD PRIMARY KEY ({})'.format(
+                name, ', '.join(preparer.quote(c.name) for c in table.primary_key.columns))))
+
+    # Indexes added to existing tables, such as the one children are
+    # replaced by on balance_transaction_fee_details
+    for table in metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        indexed = set(i['name'] for i in inspector.get_indexes(table.name, schema=SCHEMANAME))
+        for index in table.indexes:
+            if index.name in indexed:
+                continue
+            conn.execute(text('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                preparer.quote(index.name), preparer.format_table(table),
+                ', '.join(preparer.quote(c.name) for c in index.columns))))
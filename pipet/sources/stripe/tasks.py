@@ -1,21 +1,142 @@
+import logging
+import time
+
 from celery import group
 from celery_once import QueueOnce
 
-from pipet import app, celery, db
-from pipet.sources.stripe import StripeAccount
+from pipet import app, celery, db, metrics, redis_client
+from pipet.sources.stripe import RECONCILE_INTERVAL, StripeAccount
+from pipet.sources.stripe.coalesce import Coalescer, WEBHOOK_COALESCE_WINDOW, collect
+from pipet.sources.stripe.models import MODELS, SCHEMANAME, checkpoints, migrate
+from pipet.utils.raw import RAW_LANDING, create_raw_tables, materialize as materialize_raw
+from pipet.utils.ratelimit import RateLimited
+from pipet.utils.scheduler import SYNC_DISPATCH_LIMIT, SyncSchedule
+
+
+schedule = SyncSchedule(redis_client, SCHEMANAME)
 
 
 @celery.task(base=QueueOnce, once={'graceful': True})
 def sync(account_id):
+    """
+    Return:
+        int: number of rows written
+    """
     with app.app_context():
         account = StripeAccount.query.get(account_id)
-        if account.backfilled:
-            account.update()
-        else:
-            account.backfill()
+        rows, behind = 0, False
+        start = time.time()
+        session = account.organization.create_session()
+        try:
+            migrate(session.connection())
+            if RAW_LANDING:
+                create_raw_tables(session.connection(), MODELS, checkpoints)
+            session.commit()
+        finally:
+            session.close()
+        # Backfills run for hours, longer than the lease and the lock
+        heartbeat = schedule.heartbeat(str(account_id), sync.get_key(args=[account_id]))
+        try:
+            if account.backfilled:
+                rows = account.update(heartbeat=heartbeat)
+            else:
+                rows = account.backfill(heartbeat=heartbeat)
+        except RateLimited as e:
+            # Progress is checkpointed, the next run picks up from here
+            logging.warning('<StripeAccount {}> {}'.format(account_id, e))
+            behind = True
+        finally:
+            metrics.observe('sync_run_seconds', time.time() - start,
+                            source=SCHEMANAME, account=account_id)
+            schedule.complete(str(account_id), rows, behind,
+                              min_interval=RECONCILE_INTERVAL if account.webhook_secret else None)
+        return rows
+
+
+@celery.task(base=QueueOnce, once={'graceful': True})
+def materialize(account_id):
+    """
+    Materialize the typed tables from the objects landed in raw tables since
+    the last run, committing each class with its watermark.
+    """
+    with app.app_context():
+        account = StripeAccount.query.get(account_id)
+        selection = account.selection
+        session = account.organization.create_session()
+        try:
+            create_raw_tables(session.connection(), MODELS, checkpoints)
+            for cls in selection.models(MODELS):
+                start = time.time()
+                written = materialize_raw(session.connection(), cls, checkpoints, selection)
+                session.commit()
+                if written:
+                    metrics.record_write(written, time.time() - start,
+                                         source=SCHEMANAME, account=account_id)
+        finally:
+            session.close()
+
+
+@celery.task
+def materialize_all():
+    for account in StripeAccount.query.all():
+        materialize.delay(account.id)
+
+
+@celery.task
+def dispatch():
+    """
+    Start the syncs that are due, most overdue first.
+    """
+    for account_id in schedule.due(SYNC_DISPATCH_LIMIT):
+        sync.delay(int(account_id))
+
+
+@celery.task
+def enroll():
+    """
+    Add new accounts to the schedule and drop deleted ones.
+    """
+    schedule.sync(account.id for account in StripeAccount.query.all())
 
 
 @celery.task
 def sync_all():
     job = group([sync.s(account.id) for account in StripeAccount.query.all()])
     job.apply_async()
+
+
+@celery.task(bind=True)
+def flush_webhooks(self, account_id):
+    """
+    Write the objects received by webhook since the last flush. Flushes of
+    an account wait for each other, so an older version of an object is
+    never committed after a newer one.
+    """
+    coalescer = Coalescer(redis_client, account_id)
+    lock = coalescer.lock()
+    if not lock.acquire(blocking_timeout=WEBHOOK_COALESCE_WINDOW):
+        raise self.retry(countdown=WEBHOOK_COALESCE_WINDOW)
+
+    try:
+        with app.app_context():
+            account = StripeAccount.query.get(account_id)
+            objects = coalescer.drain()
+            if not objects or not account.backfilled:
+                # Until the backfill is done, `update` will catch up on these
+                return
+
+            session = account.organization.create_session()
+            try:
+                metrics.write_batch(account.selection.apply(collect(objects, account)),
+                                    session.connection(),
+                                    source=SCHEMANAME, account=account_id)
+                session.commit()
+            except Exception:
+                session.rollback()
+                coalescer.restore(objects)
+                raise
+            finally:
+                session.close()
+            coalescer.written(objects)
+    finally:
+        lock.release()
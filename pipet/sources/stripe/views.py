@@ -5,7 +5,8 @@ import stripe
 from pipet import db
 from pipet.sources.stripe import StripeAccount
 from pipet.sources.stripe.forms import CreateAccountForm
-from pipet.sources.stripe.models import SCHEMANAME
+from pipet.sources.stripe.models import SCHEMANAME, metadata
+from pipet.utils.syncconfig import SyncConfig, table_choices
 
 
 blueprint = Blueprint(SCHEMANAME, __name__, template_folder='templates')
@@ -20,14 +21,23 @@ def index():
 @blueprint.route('/activate', methods=['GET', 'POST'])
 @login_required
 def activate():
-    session = current_user.organization.create_session()
     form = CreateAccountForm()
+    choices = table_choices(metadata)
+    form.tables.choices = [(t, t) for t in choices]
     account = current_user.organization.stripe_account
     if form.validate_on_submit():
+        try:
+            sync_config = SyncConfig.from_form(form.tables.data, form.columns.data, choices)
+        except ValueError as e:
+            form.columns.errors.append(str(e))
+            return render_template('stripe/activate.html', form=form)
+
         if not account:
             account = StripeAccount()
 
         account.api_key = form.api_key.data
+        account.webhook_secret = form.webhook_secret.data or None
+        account.set_sync_config(sync_config)
         account.organization_id = current_user.organization.id
 
         db.session.add(account)
@@ -35,8 +45,12 @@ def activate():
 
         return redirect(url_for('stripe.index'))
 
+    if request.method == 'GET':
+        form.tables.data, form.columns.data = SyncConfig(
+            account.sync_config if account else None).to_form(choices)
     if account:
         form.api_key.data = account.api_key
+        form.webhook_secret.data = account.webhook_secret
 
     return render_template('stripe/activate.html', form=form)
 
@@ -53,4 +67,5 @@ def reset():
     session = current_user.organization.create_session()
     current_user.organization.stripe_account.drop_all(session)
     current_user.organization.stripe_account.create_all(session)
+    session.close()
     return redirect(url_for('stripe.index'))
@@ -0,0 +1,51 @@
+import json
+import logging
+import os
+
+from flask import Blueprint, abort, jsonify, request
+import stripe
+
+from pipet import csrf, redis_client
+from pipet.sources.stripe import StripeAccount, get_class_for_object_type
+from pipet.sources.stripe.coalesce import Coalescer, WEBHOOK_COALESCE_WINDOW
+from pipet.sources.stripe.tasks import flush_webhooks
+
+
+# Seconds of clock skew allowed when checking webhook signatures
+WEBHOOK_TOLERANCE = int(os.environ.get('STRIPE_WEBHOOK_TOLERANCE', 300))
+
+blueprint = Blueprint('stripe_webhooks', __name__)
+csrf.exempt(blueprint)
+
+
+@blueprint.route('/<int:account_id>', methods=['POST'])
+def receive(account_id):
+    account = StripeAccount.query.get(account_id)
+    if not account or not account.webhook_secret:
+        abort(404)
+
+    payload = request.get_data(as_text=True)
+    try:
+        stripe.WebhookSignature.verify_header(
+            payload, request.headers.get('Stripe-Signature', ''),
+            account.webhook_secret, WEBHOOK_TOLERANCE)
+    except stripe.error.SignatureVerificationError:
+        abort(400)
+
+    event = json.loads(payload)
+    data = event['data']['object']
+    try:
+        cls = get_class_for_object_type(data.get('object'))
+    except ValueError:
+        cls = None
+    if not cls or not account.selection.enabled(cls.__tablename__):
+        # Acknowledge events for objects without a synced model so Stripe
+        # stops retrying them
+        return jsonify(received=False)
+
+    coalescer = Coalescer(redis_client, account_id)
+    coalescer.add(data, event['created'])
+    if coalescer.schedule():
+        flush_webhooks.apply_async((account_id, ), countdown=WEBHOOK_COALESCE_WINDOW)
+    logging.debug('<StripeAccount {}> received {}'.format(account_id, event['id']))
+    return jsonify(received=True)
@@ -1,11 +1,29 @@
+import os
+
 from flask import url_for
-import requests
 from sqlalchemy import create_engine
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.schema import DDL
 
+from pipet import metrics, redis_client
 from pipet.models import db
-from pipet.sources.zendesk.models import Base, SCHEMANAME
+from pipet.sources.zendesk.models import Base, SCHEMANAME, SYNC_MODELS, checkpoints, raw_metadata
+from pipet.utils.checkpoint import delete_checkpoints
+from pipet.utils.http import HTTP_TIMEOUT, get_session
+from pipet.utils.ratelimit import RequestScheduler
+from pipet.utils.syncconfig import SyncConfig
+
+
+# Every account has its own subdomain, so keep pools for more hosts
+HTTP_POOL_HOSTS = int(os.environ.get('ZENDESK_HTTP_POOL_HOSTS', 100))
+# Zendesk limits are per minute and depend on the plan
+REQUESTS_PER_MINUTE = float(os.environ.get('ZENDESK_REQUESTS_PER_MINUTE', 200))
+# Seconds ticket ids from the hook are collected before they're fetched
+HOOK_FLUSH_WINDOW = int(os.environ.get('ZENDESK_HOOK_FLUSH_WINDOW', 10))
+
+scheduler = RequestScheduler(SCHEMANAME, REQUESTS_PER_MINUTE / 60,
+                             capacity=REQUESTS_PER_MINUTE / 6, redis=redis_client,
+                             metrics=metrics)
 
 
 class ZendeskAccount(db.Model):
@@ -14,7 +32,10 @@ class ZendeskAccount(db.Model):
     api_key = db.Column(db.Text)
     # has the database schema and tables been created
     initialized = db.Column(db.Boolean)
+    # summary of the sync cursors, which are checkpointed in the warehouse
     cursors = db.Column(JSON, default=lambda: {})
+    # tables and columns synced, see `SyncConfig`
+    sync_config = db.Column(JSON)
 
     organization_id = db.Column(db.Integer, db.ForeignKey('organization.id'))
 
@@ -29,10 +50,80 @@ class ZendeskAccount(db.Model):
     def auth(self):
         return self.admin_email + '/token', self.api_key
 
+    @property
+    def selection(self):
+        return SyncConfig(self.sync_config)
+
+    def set_sync_config(self, config):
+        """
+        Change the synced tables. Pages of disabled tables were dropped, so
+        endpoints with a table enabled again sync again from the start.
+        """
+        previous = self.selection
+        self.sync_config = config
+        selection = self.selection
+        restart = [m.__tablename__ for m in SYNC_MODELS
+                   if any(selection.enabled(t) and not previous.enabled(t)
+                          for t in m.table_names())]
+        if not restart:
+            return
+
+        self.cursors = {k: v for k, v in (self.cursors or {}).items() if k not in restart}
+        if self.initialized:
+            session = self.organization.create_session()
+            try:
+                delete_checkpoints(session.connection(), checkpoints, restart)
+                session.commit()
+            finally:
+                session.close()
+
     def get(self, path, **kwargs):
-        kwargs['url'] = self.base_url + path
-        kwargs['auth'] = account.auth
-        return requests.get(**kwargs)
+        kwargs['auth'] = self.auth
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        session = get_session(SCHEMANAME, pool_connections=HTTP_POOL_HOSTS)
+        return scheduler.request(self.id, lambda: session.get(
+            self.base_url + path, **kwargs))
+
+    def set_cursor(self, name, cursor):
+        """
+        Store one endpoint's cursor. Endpoints sync concurrently, so the key
+        is merged in the database rather than rewriting the whole column.
+        """
+        db.session.execute(
+            'UPDATE {table} SET cursors = (COALESCE(cursors::jsonb, \'{{}}\') || '
+            'jsonb_build_object(CAST(:name AS text), CAST(:cursor AS text)))::json '
+            'WHERE id = :id'.format(table=self.__tablename__),
+            {'name': name, 'cursor': cursor, 'id': self.id})
+        db.session.commit()
+
+    @property
+    def pending_tickets_key(self):
+        return 'zendesk:{}:pending_tickets'.format(self.id)
+
+    def enqueue_tickets(self, ticket_ids, window=HOOK_FLUSH_WINDOW):
+        """
+        Queue tickets changed according to the hook. A set, so a burst of
+        updates to one ticket fetches it once.
+
+        Return:
+            bool: True if the caller should schedule a flush in `window`
+                seconds, i.e. one isn't already scheduled
+        """
+        pipe = redis_client.pipeline()
+        pipe.sadd(self.pending_tickets_key, *ticket_ids)
+        pipe.set(self.pending_tickets_key + ':scheduled', 1, nx=True, ex=window)
+        return bool(pipe.execute()[1])
+
+    def drain_tickets(self):
+        """
+        Atomically take every queued ticket id.
+        """
+        redis_client.delete(self.pending_tickets_key + ':scheduled')
+        pipe = redis_client.pipeline()
+        pipe.smembers(self.pending_tickets_key)
+        pipe.delete(self.pending_tickets_key)
+        ticket_ids, _ = pipe.execute()
+        return sorted(int(i) for i in ticket_ids)
 
     def create_all(self, session):
         session.bind.execute(
@@ -41,7 +132,20 @@ class ZendeskAccount(db.Model):
         self.initialized = True
 
     def drop_all(self, session):
+        raw_metadata.drop_all(session.bind)
         Base.metadata.drop_all(session.bind)
         session.bind.execute(
             DDL('DROP SCHEMA IF EXISTS {schema}'.format(schema=SCHEMANAME)))
         self.initialized = False
+        self.cursors = {}
+
+    def reset(self, session):
+        """
+        Drop and recreate the tables, so every endpoint syncs again from the
+        start. The checkpoints are dropped with the tables and the cursor
+        summary is cleared, which is committed here.
+        """
+        self.drop_all(session)
+        self.create_all(session)
+        db.session.add(self)
+        db.session.commit()
@@ -1,8 +1,10 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, validators
+from wtforms import StringField, TextAreaField, validators
 from wtforms.fields import BooleanField
 from wtforms.fields.html5 import EmailField
 
+from pipet.forms import MultiCheckboxField
+
 
 class CreateAccountForm(FlaskForm):
     subdomain = StringField('Subdomain', validators=[
@@ -11,6 +13,11 @@ class CreateAccountForm(FlaskForm):
                              validators.DataRequired()])
     api_key = StringField('API Key', validators=[validators.DataRequired()])
     backfill = BooleanField('Backfill Zendesk data?')
+    tables = MultiCheckboxField('Tables', validators=[
+                                validators.DataRequired()])
+    columns = TextAreaField('Columns', description=(
+                            'One table per line, as `table: column, column`, '
+                            'to only sync those columns'))
 
 
 class DestroyAccountForm(FlaskForm):
@@ -2,7 +2,6 @@ from datetime import datetime
 import os
 
 from flask import url_for
-from requests.exceptions import HTTPError
 from sqlalchemy import Column
 from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.ext.declarative import as_declarative
@@ -10,11 +9,26 @@ from sqlalchemy.orm import backref, relationship
 from sqlalchemy.schema import MetaData
 from sqlalchemy.types import BigInteger, Boolean, Text, Integer, DateTime
 
-from pipet.utils import PipetBase
+from pipet.utils import PipetBase, UpsertBatch
+from pipet.utils.checkpoint import checkpoint_table
+from pipet.utils.raw import raw_table
 
 
 SCHEMANAME = 'zendesk'
 CLASS_REGISTRY = {}
+# Records per incremental export page, at most 1000
+PAGE_SIZE = int(os.environ.get('ZENDESK_PAGE_SIZE', 1000))
+# raw landing tables, only created when raw landing is on
+raw_metadata = MetaData(schema=SCHEMANAME)
+
+
+def parse_timestamp(value):
+    """
+    Parse Zendesk's `2018-03-01T12:34:56Z` timestamps, which we assume are
+    GMT. Slicing is several times faster than `strptime`.
+    """
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19]))
 
 
 @as_declarative(metadata=MetaData(schema=SCHEMANAME), class_registry=CLASS_REGISTRY)
@@ -22,47 +36,93 @@ class Base(PipetBase):
     id = Column(BigInteger, primary_key=True)
 
     @classmethod
-    def parse(cls, data):
-        d = {}
-        for field, column in cls.__table__._columns.items():
+    def compile_parse_plan(cls):
+        plan = []
+        for field, column in cls.__table__.columns.items():
             # metadata is not a valid column name
-            value = data.get('meta' if field == 'metadata' else field, None)
-            if not value:
-                continue
-            elif isinstance(column.type, DateTime):
-                # We assume GMT
-                d[field] = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
-            else:
-                d[field] = value
-        return d
+            data_field = 'meta' if field == 'metadata' else field
+            convert = parse_timestamp if isinstance(
+                column.type, DateTime) else None
+            plan.append((data_field, field, convert))
+        return plan
+
+    # incremental export endpoint
+    endpoint = None
+    # cursor-based exports page with `after_cursor`, time-based ones with `end_time`
+    cursor_based = True
+    # sideloaded response keys and their models
+    sideloads = {}
 
     @classmethod
-    def process_response(cls, response):
-        raise NotImplemented
+    def table_names(cls):
+        """
+        Return:
+            list: names of the tables filled by syncing this model, its own
+                and its sideloads'
+        """
+        return [cls.__tablename__] + [m.__tablename__ for m in cls.sideloads.values()]
 
     @classmethod
-    def sync(cls, account):
+    def process_response(cls, page):
         """
+        Args:
+            page (dict): decoded export page
         Return:
-            statements (list): list of insert insertments
-            cursor (str): cursor for sync
-            has_more (bool): continue sync'ing
+            UpsertBatch: the page's records and sideloads
         """
-        statements = []
-        cursor = account.cursors.get(cls.__tablename__, '0')
+        batch = UpsertBatch()
+        for data in page.get(cls.__tablename__, []):
+            cls.collect(batch, data)
 
-        resp = account.get(cls.endpoint.format(cursor=cursor))
+        for key, model in cls.sideloads.items():
+            for data in page.get(key, []):
+                model.collect(batch, data)
 
-        try:
-            resp.raise_for_status()
-        except HTTPError:
-            if resp.status_code == 429:
-                return statements, cursor, False
-            raise HTTPError
+        return batch
 
-        statements += cls.process_response(resp)
-        cursor = resp.json()['end_time']
-        return statements, cursor, resp.json()['count'] == 1000
+    @classmethod
+    def sync(cls, account, cursor=None):
+        """
+        Fetch one page of the incremental export after `cursor`, or from the
+        beginning if there's no cursor yet.
+
+        Cursor-based exports don't repeat records that share a timestamp
+        across a page boundary, unlike time-based ones, so they are used
+        wherever Zendesk offers them.
+
+        Return:
+            batch (UpsertBatch): rows to write
+            cursor (str): cursor for sync
+            has_more (bool): continue sync'ing
+        """
+        if cursor is not None:
+            # cursors saved by the old time-based sync are ints
+            cursor = str(cursor)
+        params = {'per_page': PAGE_SIZE}
+        if cls.sideloads:
+            params['include'] = ','.join(cls.sideloads)
+        if cursor is None:
+            params['start_time'] = 0
+        elif cls.cursor_based and not cursor.isdigit():
+            params['cursor'] = cursor
+        else:
+            # also resumes cursors saved before the cursor-based exports
+            params['start_time'] = cursor
+
+        resp = account.get(cls.endpoint, params=params)
+        resp.raise_for_status()
+        page = resp.json()
+
+        batch = cls.process_response(page)
+        has_more = not page['end_of_stream']
+        if cls.cursor_based:
+            next_cursor = page.get('after_cursor') or cursor
+        else:
+            next_cursor = str(page.get('end_time') or cursor)
+            # More records share the boundary timestamp than fit on a page,
+            # so the export can't advance. Pick it up on the next run.
+            has_more = has_more and next_cursor != cursor
+        return batch, next_cursor, has_more
 
 
 class UserIdentity(Base):
@@ -78,9 +138,9 @@ class UserIdentity(Base):
     deliverable_sate = Column(Text)
 
     @classmethod
-    def sync(cls, account):
+    def sync(cls, account, cursor=None):
         # synced from User.sync
-        return [], None, False
+        return UpsertBatch(), None, False
 
 
 class User(Base):
@@ -121,19 +181,8 @@ class User(Base):
     user_fields = Column(JSONB)
     verified = Column(Boolean)
 
-    endpoint = '/api/v2/incremental/users.json?start_time={cursor}&include=identities'
-
-    @classmethod
-    def process_response(cls, response):
-        statements = []
-        for data in response.json().get('users', []):
-            statements.append(cls.upsert(cls.parse(data)))
-
-        for identity_data in response.json().get('identities', []):
-            statements.append(UserIdentity.upsert(
-                UserIdentity.parse(identity_data)))
-
-        return statements
+    endpoint = '/api/v2/incremental/users/cursor.json'
+    sideloads = {'identities': UserIdentity}
 
 
 class Group(Base):
@@ -148,21 +197,14 @@ class Group(Base):
     endpoint = '/api/v2/groups.json'
 
     @classmethod
-    def process_response(cls, response):
-        statements = []
-        for data in response.json().get('groups', []):
-            statements.append(cls.upsert(cls.parse(data)))
-        return statements
-
-    @classmethod
-    def sync(cls, account):
+    def sync(cls, account, cursor=None):
         """
         Returns:
-            (list): statements to execute
+            (UpsertBatch): rows to write
             (str): cursor
             (bool): whether to call again immediately
         """
-        return [], None, False
+        return UpsertBatch(), None, False
 
 
 class Organization(Base):
@@ -179,15 +221,9 @@ class Organization(Base):
     tags = Column(ARRAY(Text, dimensions=1))
     organization_fields = Column(JSONB)
 
-    endpoint = '/api/v2/incremental/organizations.json?start_time={cursor}'
-
-    @classmethod
-    def process_response(cls, response):
-        statements = []
-        for data in response.json().get('organizations', []):
-            statements.append(cls.upsert(cls.parse(data)))
-
-        return statements
+    # Zendesk has no cursor-based export for organizations
+    endpoint = '/api/v2/incremental/organizations.json'
+    cursor_based = False
 
 
 # class TicketAudit(Base):
@@ -240,15 +276,41 @@ class Ticket(Base):
     # allow_channelback
     # is_public
 
-    endpoint = '/api/v2/incremental/tickets.json?start_time={cursor}&include=groups'
+    endpoint = '/api/v2/incremental/tickets/cursor.json'
+    sideloads = {'groups': Group}
+    # most ids show_many accepts per request
+    show_many_limit = 100
 
     @classmethod
-    def process_response(cls, response):
-        statements = []
-        for data in response.json().get('tickets', []):
-            statements.append(cls.upsert(cls.parse(data)))
+    def show_many(cls, account, ids):
+        """
+        Fetch tickets by id, with their users and groups, a page of ids per
+        request. Deleted tickets are left out by Zendesk.
+
+        Return:
+            UpsertBatch: rows to write
+        """
+        batch = UpsertBatch()
+        for i in range(0, len(ids), cls.show_many_limit):
+            resp = account.get('/api/v2/tickets/show_many.json', params={
+                'ids': ','.join(str(id) for id in ids[i:i + cls.show_many_limit]),
+                'include': 'users,groups',
+            })
+            resp.raise_for_status()
+            page = resp.json()
+
+            batch.extend(cls.process_response(page))
+            for data in page.get('users', []):
+                User.collect(batch, data)
+        return batch
+
+
+# Models with their own incremental export, each synced independently
+SYNC_MODELS = (User, Organization, Ticket)
 
-        for data in response.json().get('groups', []):
-            statements.append(Group.upsert(Group.parse(data)))
+MODELS = tuple(m for m in CLASS_REGISTRY.values()
+               if isinstance(m, type) and issubclass(m, Base))
+for m in MODELS:
+    raw_table(m.__table__, raw_metadata)
 
-        return statements
+checkpoints = checkpoint_table(Base.metadata)
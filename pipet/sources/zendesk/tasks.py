@@ -1,49 +1,201 @@
-from contextlib import contextmanager
-from datetime import datetime
-from inspect import isclass
+import os
+import time
 
-from celery import chord, group
+from celery import group
 from celery_once import QueueOnce
-from celery.schedules import crontab
 from celery.utils.log import get_task_logger
-from sqlalchemy.orm.attributes import flag_modified
 
-from pipet import celery, db
-from pipet.models import Organization
-from pipet.sources.zendesk import ZendeskAccount
+from pipet import app, celery, metrics, redis_client
+from pipet.sources.zendesk import HOOK_FLUSH_WINDOW, ZendeskAccount
 from pipet.sources.zendesk.models import (
-    Base,
     CLASS_REGISTRY,
+    MODELS,
+    SCHEMANAME,
+    SYNC_MODELS,
+    Ticket,
+    checkpoints,
 )
+from pipet.utils.bulk import is_empty
+from pipet.utils.checkpoint import load_checkpoint, save_checkpoint
+from pipet.utils.ratelimit import RateLimited
+from pipet.utils.raw import RAW_LANDING, create_raw_tables, materialize as materialize_raw
+from pipet.utils.scheduler import SYNC_DISPATCH_LIMIT, SyncSchedule
 
 
 logger = get_task_logger(__name__)
+# Pages written between cursor checkpoints
+CHECKPOINT_PAGES = int(os.environ.get('ZENDESK_CHECKPOINT_PAGES', 1))
+
+# Endpoints are scheduled independently, as `<account id>:<model>`
+schedule = SyncSchedule(redis_client, SCHEMANAME)
 
 
 @celery.task(base=QueueOnce, once={'graceful': True})
 def sync(account_id):
+    """
+    Sync every enabled incremental endpoint as its own task, so a slow
+    export doesn't hold up the others. Requests still share the account's
+    rate limit.
+    """
+    with app.app_context():
+        models = ZendeskAccount.query.get(account_id).selection.models(SYNC_MODELS)
+    job = group([sync_endpoint.s(account_id, cls.__name__)
+                 for cls in models])
+    job.apply_async()
+
+
+@celery.task(base=QueueOnce, once={'graceful': True})
+def sync_endpoint(account_id, model):
+    """
+    Sync one incremental endpoint. The lock is per account and model, and
+    so is the cursor.
+
+    Cursors are checkpointed in the warehouse in the same transaction as
+    the rows, every `CHECKPOINT_PAGES` pages, so a crash never applies a
+    page twice or skips one. `ZendeskAccount.cursors` only gets a summary
+    at the end of the run.
+
+    Return:
+        int: number of rows written
+    """
     with app.app_context():
         account = ZendeskAccount.query.get(account_id)
+        selection = account.selection
+        cls = CLASS_REGISTRY[model]
+        name = cls.__tablename__
+        if not selection.enabled(name):
+            # disabled since it was scheduled, `enroll` unschedules it
+            return 0
+        labels = {'source': SCHEMANAME, 'account': account_id, 'resource': name}
+        member = '{}:{}'.format(account_id, model)
+        # First exports of large accounts run longer than the lease and the lock
+        heartbeat = schedule.heartbeat(member, sync_endpoint.get_key(args=[account_id, model]))
+        start = time.time()
         session = account.organization.create_session()
 
-        for cls in [m for n, m in CLASS_REGISTRY.items() if isclass(m) and issubclass(m, Base)]:
-            # TODO: Make these parallel to speed up execution
-            while True:
-                conn = session.connection()
-                statments, cursor, has_more = cls.sync(account)
-                account.cursors[cls.__tablename__] = cursor
-                flag_modified(account, 'cursors')
+        try:
+            conn = session.connection()
+            checkpoints.create(conn, checkfirst=True)
+            if RAW_LANDING:
+                create_raw_tables(conn, MODELS, checkpoints)
+            # Tables loaded for the first time are bulk loaded with COPY
+            bulk = is_empty(conn, cls.__table__)
+            # Accounts synced before checkpoints start from their summary
+            cursor = load_checkpoint(conn, checkpoints, name) or \
+                account.cursors.get(name)
 
-                for statement in statments:
-                    conn.execute(statement)
+            pages = rows = 0
+            behind = False
+            try:
+                while True:
+                    batch, cursor, has_more = cls.sync(account, cursor)
+                    rows += len(batch)
+                    metrics.record_page(len(batch), **labels)
+                    metrics.write_batch(selection.apply(batch), conn, bulk=bulk, **labels)
 
+                    pages += 1
+                    if pages % CHECKPOINT_PAGES == 0:
+                        save_checkpoint(conn, checkpoints, name, cursor)
+                        session.commit()
+                        conn = session.connection()
+
+                    heartbeat()
+                    if not has_more:
+                        break
+            except RateLimited as e:
+                # Pages written so far are kept, the next run picks up from here
+                logger.warning('<ZendeskAccount {}> {} {}'.format(
+                    account_id, model, e))
+                behind = True
+
+            save_checkpoint(conn, checkpoints, name, cursor)
+            session.commit()
+        finally:
+            session.close()
+
+        account.set_cursor(name, cursor)
+        metrics.observe('sync_run_seconds', time.time() - start, **labels)
+        schedule.complete(member, rows, behind)
+        return rows
+
+
+@celery.task
+def flush_hook(account_id):
+    """
+    Fetch and write the tickets queued by the hook since the last flush.
+    """
+    with app.app_context():
+        account = ZendeskAccount.query.get(account_id)
+        ticket_ids = account.drain_tickets()
+        if not ticket_ids or not account.selection.enabled(Ticket.__tablename__):
+            return
+
+        session = account.organization.create_session()
+        try:
+            metrics.write_batch(account.selection.apply(Ticket.show_many(account, ticket_ids)),
+                                session.connection(), source=SCHEMANAME, account=account_id)
+            session.commit()
+        except RateLimited as e:
+            # The incremental export picks these up on its next run
+            session.rollback()
+            logger.warning('<ZendeskAccount {}> hook {}'.format(account_id, e))
+        except Exception:
+            session.rollback()
+            if account.enqueue_tickets(ticket_ids):
+                flush_hook.apply_async((account_id, ), countdown=HOOK_FLUSH_WINDOW)
+            raise
+        finally:
+            session.close()
+
+
+@celery.task(base=QueueOnce, once={'graceful': True})
+def materialize(account_id):
+    """
+    Materialize the typed tables from the objects landed in raw tables since
+    the last run, committing each class with its watermark.
+    """
+    with app.app_context():
+        account = ZendeskAccount.query.get(account_id)
+        selection = account.selection
+        session = account.organization.create_session()
+        try:
+            create_raw_tables(session.connection(), MODELS, checkpoints)
+            for cls in selection.models(MODELS):
+                start = time.time()
+                written = materialize_raw(session.connection(), cls, checkpoints, selection)
                 session.commit()
+                if written:
+                    metrics.record_write(written, time.time() - start,
+                                         source=SCHEMANAME, account=account_id)
+        finally:
+            session.close()
 
-                db.session.add(account)
-                db.session.commit()
 
-                if not has_more:
-                    break
+@celery.task
+def materialize_all():
+    for account in ZendeskAccount.query.all():
+        materialize.delay(account.id)
+
+
+@celery.task
+def dispatch():
+    """
+    Start the endpoint syncs that are due, most overdue first.
+    """
+    for member in schedule.due(SYNC_DISPATCH_LIMIT):
+        account_id, model = member.split(':')
+        sync_endpoint.delay(int(account_id), model)
+
+
+@celery.task
+def enroll():
+    """
+    Schedule every enabled endpoint of new accounts, and drop deleted
+    accounts and disabled endpoints.
+    """
+    schedule.sync('{}:{}'.format(account.id, cls.__name__)
+                  for account in ZendeskAccount.query.all()
+                  for cls in account.selection.models(SYNC_MODELS))
 
 
 @celery.task
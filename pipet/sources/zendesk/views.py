@@ -2,14 +2,14 @@ from datetime import datetime
 
 from flask import Blueprint, redirect, request, Response, render_template, url_for
 from flask_login import current_user, login_required
-import requests
 from sqlalchemy.exc import ProgrammingError
 
-from pipet import db
-from pipet.sources.zendesk import ZendeskAccount
+from pipet import csrf, db
+from pipet.sources.zendesk import HOOK_FLUSH_WINDOW, ZendeskAccount
 from pipet.sources.zendesk.forms import CreateAccountForm, DestroyAccountForm
-from pipet.sources.zendesk.models import Base, SCHEMANAME
-from pipet.sources.zendesk.tasks import sync
+from pipet.sources.zendesk.models import Base, SCHEMANAME, Ticket
+from pipet.sources.zendesk.tasks import flush_hook, sync
+from pipet.utils.syncconfig import SyncConfig, table_choices
 
 
 blueprint = Blueprint(SCHEMANAME, __name__, template_folder='templates')
@@ -24,23 +24,34 @@ def index():
 @blueprint.route('/activate', methods=['GET', 'POST'])
 @login_required
 def activate():
-    session = current_user.organization.create_session()
     form = CreateAccountForm(obj=current_user.organization.zendesk_account)
+    choices = table_choices(Base.metadata)
+    form.tables.choices = [(t, t) for t in choices]
     account = current_user.organization.zendesk_account
     if form.validate_on_submit():
+        try:
+            sync_config = SyncConfig.from_form(form.tables.data, form.columns.data, choices)
+        except ValueError as e:
+            form.columns.errors.append(str(e))
+            return render_template('zendesk/activate.html', form=form)
+
         if not account:
             account = ZendeskAccount()
 
         account.subdomain = form.subdomain.data
         account.admin_email = form.admin_email.data
         account.api_key = form.api_key.data
-        account.organization_id = current_user.organization.id
+        account.organization = current_user.organization
+        account.set_sync_config(sync_config)
 
         db.session.add(account)
         db.session.commit()
 
         return redirect(url_for('zendesk.index'))
 
+    if request.method == 'GET':
+        form.tables.data, form.columns.data = SyncConfig(
+            account.sync_config if account else None).to_form(choices)
     if account:
         form.subdomain.data = account.subdomain
         form.admin_email.data = account.admin_email
@@ -69,38 +80,36 @@ def deactivate():
 @login_required
 def reset():
     session = current_user.organization.create_session()
-    current_user.organization.zendesk_account.drop_all(session)
-    current_user.organization.zendesk_account.create_all(session)
+    current_user.organization.zendesk_account.reset(session)
+    session.close()
     return redirect(url_for('zendesk.index'))
 
 
 @blueprint.route("/hook", methods=['POST'])
+@csrf.exempt
 def hook():
+    """
+    Called by a Zendesk trigger with `{"id": <ticket id>}` whenever a ticket
+    changes. Tickets are fetched in bulk by `flush_hook`, so acknowledge
+    straight away.
+    """
     if not request.authorization:
         return ('', 401)
 
-    account = Account.query.filter((Account.subdomain == request.authorization.username) &
-                                   (Account.api_key == request.authorization.password)).first()
-
-    scoped_session = account.organization.create_scoped_session()
-    session = scoped_session()
-
+    account = ZendeskAccount.query.filter(
+        (ZendeskAccount.subdomain == request.authorization.username) &
+        (ZendeskAccount.api_key == request.authorization.password)).first()
     if not account:
         return ('', 401)
 
-    ticket_id = request.get_json()['id']
-    resp = requests.get(account.api_base_url +
-                        '/tickets/{id}.json?include=users,groups'.format(
-                            id=ticket_id),
-                        auth=account.auth)
-
-    ticket, _ = Ticket.create_or_update(resp.json()['ticket'], account)
-    session.add_all(ticket.update(resp.json()))
-    session.add(ticket)
-
-    resp = requests.get(account.api_base_url +
-                        '/tickets/{id}/comments.json'.format(id=ticket.id), auth=account.auth)
+    data = request.get_json(silent=True) or {}
+    try:
+        ticket_id = int(data['id'])
+    except (KeyError, TypeError, ValueError):
+        return ('', 400)
 
-    session.add_all(ticket.update_comments(resp.json()['comments']))
-    session.commit()
+    if not account.selection.enabled(Ticket.__tablename__):
+        return ('', 204)
+    if account.enqueue_tickets([ticket_id]):
+        flush_hook.apply_async((account.id, ), countdown=HOOK_FLUSH_WINDOW)
     return ('', 204)
@@ -1,11 +1,21 @@
+from collections import OrderedDict
+import os
+
 from flask_sqlalchemy import camel_to_snake_case
 from inflection import tableize
-from sqlalchemy import Column
+from sqlalchemy import Column, tuple_
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.declarative import declared_attr
 
 from sqlalchemy.types import BigInteger
 
+from pipet.utils.bulk import bulk_upsert, copy_rows
+from pipet.utils.raw import RAW_LANDING, json_expression, upsert_from
+
+
+# Maximum number of rows sent in a single multi-row INSERT
+UPSERT_BATCH_SIZE = int(os.environ.get('UPSERT_BATCH_SIZE', 500))
+
 
 class PipetBase():
     @declared_attr
@@ -21,7 +31,341 @@ class PipetBase():
         Return:
             tuple: (object, created)
         """
-        return insert(cls.__table__).values(**data).on_conflict_do_update(index_elements=[cls.id], set_=data)
+        stmt = insert(cls.__table__).values(**data)
+        return stmt.on_conflict_do_update(index_elements=[cls.id], set_=data,
+                                          where=changed(stmt, cls.__table__, data))
+
+    @classmethod
+    def compile_parse_plan(cls):
+        """
+        Return:
+            list: (data key, column key, converter or None) for each column
+        """
+        return [(key, key, None) for key in cls.__table__.columns.keys()]
+
+    @classmethod
+    def parse_plan(cls):
+        """
+        The class's parse plan, compiled on first use. Subclasses each get
+        their own, so it's looked up in the class's own `__dict__`.
+        """
+        plan = cls.__dict__.get('_parse_plan')
+        if plan is None:
+            plan = tuple(cls.compile_parse_plan())
+            setattr(cls, '_parse_plan', plan)
+        return plan
+
+    @classmethod
+    def parse(cls, data):
+        """
+        Args:
+            data (dict): JSON object from the API
+        Return:
+            dict: row keyed by column key, without empty values
+        """
+        d = {}
+        get = data.get
+        for data_field, field, convert in cls.parse_plan():
+            value = get(data_field)
+            if value:
+                d[field] = convert(value) if convert else value
+        return d
+
+    @classmethod
+    def lands_raw(cls):
+        return RAW_LANDING and 'raw' in cls.__table__.info
+
+    @classmethod
+    def collect(cls, batch, data):
+        """
+        Add a single API object to `batch`, verbatim to the model's raw table
+        when landing raw.
+        """
+        if cls.lands_raw():
+            batch.land(cls.__table__, data)
+        else:
+            batch.upsert(cls, cls.parse(data))
+
+    @classmethod
+    def materialize_expression(cls, data_field, column, convert, payload='raw.payload'):
+        """
+        SQL counterpart of `parse` for one entry of the parse plan.
+        """
+        return json_expression(column, data_field, payload)
+
+    @classmethod
+    def materialize_columns(cls, selection=None, payload='raw.payload'):
+        """
+        Return:
+            list: (column key, SQL expression) for the selected columns
+        """
+        columns = selection.columns(cls.__table__) if selection else None
+        return [(key, cls.materialize_expression(data_field, cls.__table__.c[key], convert, payload))
+                for data_field, key, convert in cls.parse_plan()
+                if columns is None or key in columns]
+
+    @classmethod
+    def materialize(cls, conn, source, params, selection=None):
+        """
+        Upsert the objects of a raw table into the model's typed tables.
+
+        Args:
+            source (str): FROM clause with the objects as `raw.payload`,
+                bound by `params`
+            selection (SyncConfig):
+        Return:
+            dict: rows written by table name
+        """
+        return upsert_from(conn, cls.__table__, cls.materialize_columns(selection),
+                           source, params)
+
+    @classmethod
+    def upsert_many(cls, rows, batch_size=None):
+        """
+        Args:
+            rows (list): parsed rows, as returned by `parse`
+            batch_size (int): maximum rows per statement
+        Return:
+            list: multi-row upsert statements
+        """
+        return upsert_statements(cls.__table__, rows, batch_size)
 
     def __hash__(self):
         return hash(self.id)
+
+
+def changed(stmt, table, columns):
+    """
+    Guard for `ON CONFLICT DO UPDATE` that only lets rows through whose
+    incoming values differ from the stored ones, so re-reading unchanged
+    objects doesn't rewrite them.
+
+    Args:
+        stmt (Insert):
+        table (Table):
+        columns (iterable): keys of the columns being set
+    """
+    columns = list(columns)
+    return tuple_(*[table.c[k] for k in columns]).is_distinct_from(
+        tuple_(*[stmt.excluded[k] for k in columns]))
+
+
+def upsert_statements(table, rows, batch_size=None):
+    """
+    Build multi-row `INSERT ... ON CONFLICT DO UPDATE` statements.
+
+    Rows are deduplicated by primary key, the last row winning, since
+    Postgres refuses to update the same row twice in one statement.
+    Parsed rows omit empty values, so rows are grouped by the columns they
+    set and only those columns are updated on conflict, and only when one
+    of them changed.
+
+    Args:
+        table (Table):
+        rows (list): dicts keyed by column key
+        batch_size (int): maximum rows per statement
+    Return:
+        list: statements
+    """
+    batch_size = batch_size or UPSERT_BATCH_SIZE
+    primary_key = [c.key for c in table.primary_key.columns]
+
+    deduped = OrderedDict()
+    for row in rows:
+        key = tuple(row.get(k) for k in primary_key)
+        deduped.pop(key, None)
+        deduped[key] = row
+
+    groups = OrderedDict()
+    for row in deduped.values():
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+
+    statements = []
+    for columns, group in groups.items():
+        for i in range(0, len(group), batch_size):
+            stmt = insert(table).values(group[i:i + batch_size])
+            set_ = {k: stmt.excluded[k]
+                    for k in columns if k not in primary_key}
+            if set_:
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=primary_key, set_=set_,
+                    where=changed(stmt, table, set_))
+            else:
+                stmt = stmt.on_conflict_do_nothing(
+                    index_elements=primary_key)
+            statements.append(stmt)
+    return statements
+
+
+class UpsertBatch():
+    """
+    Collects parsed rows across tables so a page of API objects is written
+    with a handful of multi-row statements instead of one per object.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size
+        self.upserts = OrderedDict()
+        self.inserts = OrderedDict()
+        # table: (parent column, {parent id: rows})
+        self.replacements = OrderedDict()
+        # typed table: API objects for its raw table
+        self.landed = OrderedDict()
+        # unchanged rows left alone by the last `execute`, by table name
+        self.skipped = {}
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.upserts.values()) + \
+            sum(len(rows) for rows in self.inserts.values()) + \
+            sum(len(rows) for rows in self.landed.values()) + \
+            sum(len(rows) for _, children in self.replacements.values()
+                for rows in children.values())
+
+    def upsert(self, cls, data):
+        self.upserts.setdefault(cls.__table__, []).append(data)
+
+    def insert(self, table, rows):
+        self.inserts.setdefault(table, []).extend(rows)
+
+    def land(self, table, data):
+        """
+        Add an API object verbatim for `table`'s raw table, see
+        `pipet.utils.raw`.
+        """
+        self.landed.setdefault(table, []).append(
+            {'id': str(data['id']), 'object': data.get('object'), 'payload': data})
+
+    def replace_children(self, table, parent_column, parent_id, rows):
+        """
+        Replace every row of a child table without a key of its own, such as
+        a balance transaction's fee details, that belongs to a parent.
+
+        All the parents touched by the batch are cleared with one DELETE and
+        their children written with multi-row INSERTs, so re-syncing a
+        parent never duplicates its children.
+
+        Args:
+            table (Table): child table
+            parent_column (str): key of the column referencing the parent
+            parent_id: the parent's id
+            rows (list): the parent's children, possibly empty
+        """
+        columns = table.columns.keys()
+        rows = [dict({k: row.get(k) for k in columns}, **{parent_column: parent_id})
+                for row in rows]
+        _, children = self.replacements.setdefault(table, (parent_column, OrderedDict()))
+        children[parent_id] = rows
+
+    def extend(self, other):
+        for table, rows in other.upserts.items():
+            self.upserts.setdefault(table, []).extend(rows)
+        for table, rows in other.inserts.items():
+            self.inserts.setdefault(table, []).extend(rows)
+        for table, rows in other.landed.items():
+            self.landed.setdefault(table, []).extend(rows)
+        for table, (parent_column, children) in other.replacements.items():
+            self.replacements.setdefault(
+                table, (parent_column, OrderedDict()))[1].update(children)
+
+    def replaced(self, table):
+        """
+        Return:
+            list: children replacing those of the touched parents
+        """
+        _, children = self.replacements[table]
+        return [row for rows in children.values() for row in rows]
+
+    def delete_statements(self):
+        return [table.delete().where(table.c[parent_column].in_(list(children)))
+                for table, (parent_column, children) in self.replacements.items()]
+
+    def deduped(self, table):
+        """
+        Return:
+            list: upserted rows for `table`, deduplicated by primary key
+        """
+        primary_key = [c.key for c in table.primary_key.columns]
+        deduped = OrderedDict()
+        for row in self.upserts.get(table, []):
+            key = tuple(row.get(k) for k in primary_key)
+            deduped.pop(key, None)
+            deduped[key] = row
+        return list(deduped.values())
+
+    def statements(self):
+        statements = []
+        for table, rows in self.upserts.items():
+            statements += upsert_statements(table, rows, self.batch_size)
+        return statements + self.insert_statements()
+
+    def insert_statements(self):
+        """
+        Return:
+            list: statements for the inserted and replaced rows
+        """
+        batch_size = self.batch_size or UPSERT_BATCH_SIZE
+        statements = []
+        for table, rows in self.inserts.items():
+            for i in range(0, len(rows), batch_size):
+                statements.append(table.insert().values(
+                    rows[i:i + batch_size]))
+        statements += self.delete_statements()
+        for table in self.replacements:
+            rows = self.replaced(table)
+            for i in range(0, len(rows), batch_size):
+                statements.append(table.insert().values(
+                    rows[i:i + batch_size]))
+        return statements
+
+    def execute(self, conn, bulk=False):
+        """
+        Write the batch and empty it. Upserted rows identical to the stored
+        ones aren't rewritten, and are counted in `skipped` instead. Landed
+        objects are always loaded with COPY.
+
+        Args:
+            conn (Connection):
+            bulk (bool): load through COPY and a staging table, which is much
+                faster for large batches such as initial backfills
+        Return:
+            dict: rows written by table name
+        """
+        written = {}
+        for table, rows in self.landed.items():
+            raw = table.info['raw']
+            copy_rows(conn, raw, rows, ['id', 'object', 'payload'])
+            written[raw.name] = written.get(raw.name, 0) + len(rows)
+
+        for table, rows in list(self.inserts.items()) + \
+                [(table, self.replaced(table)) for table in self.replacements]:
+            written[table.name] = written.get(table.name, 0) + len(rows)
+
+        self.skipped = {}
+        for table in self.upserts:
+            rows = self.deduped(table)
+            if bulk:
+                count = bulk_upsert(conn, table, rows)
+            else:
+                # rowcount leaves out the conflicting rows the guard skipped
+                count = sum(conn.execute(statement).rowcount
+                            for statement in upsert_statements(table, rows, self.batch_size))
+            written[table.name] = written.get(table.name, 0) + count
+            self.skipped[table.name] = len(rows) - count
+
+        if bulk:
+            for table, rows in self.inserts.items():
+                copy_rows(conn, table, rows)
+            for statement in self.delete_statements():
+                conn.execute(statement)
+            for table in self.replacements:
+                rows = self.replaced(table)
+                if rows:
+                    copy_rows(conn, table, rows)
+        else:
+            for statement in self.insert_statements():
+                conn.execute(statement)
+        self.upserts.clear()
+        self.inserts.clear()
+        self.landed.clear()
+        self.replacements.clear()
+        return written
@@ -0,0 +1,128 @@
+from datetime import date, datetime
+import io
+import json
+import os
+
+from sqlalchemy import exists, select
+from sqlalchemy.dialects.postgresql import ARRAY, JSON
+from sqlalchemy.types import Boolean
+
+
+# Rows buffered before a bulk load is flushed
+BULK_LOAD_ROWS = int(os.environ.get('BULK_LOAD_ROWS', 5000))
+
+NULL = '\\N'
+_escapes = str.maketrans({'\\': '\\\\', '\t': '\\t',
+                          '\n': '\\n', '\r': '\\r'})
+
+
+def _array_literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (list, tuple)):
+        return '{' + ','.join(_array_literal(v) for v in value) + '}'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _encoder(column):
+    """
+    Return a function that turns a value for `column` into its COPY text
+    representation, before escaping.
+    """
+    if isinstance(column.type, JSON):
+        return json.dumps
+    if isinstance(column.type, ARRAY):
+        return _array_literal
+    if isinstance(column.type, Boolean):
+        return lambda v: 't' if v else 'f'
+    return lambda v: v.isoformat() if isinstance(v, (date, datetime)) else str(v)
+
+
+def copy_rows(conn, table, rows, columns=None, target=None):
+    """
+    Stream rows into a table with `COPY ... FROM STDIN`.
+
+    Args:
+        conn (Connection):
+        table (Table): table the rows belong to
+        rows (list): dicts keyed by column key
+        columns (list): column keys to load, defaults to every column
+        target (str): name to copy into instead of `table`, e.g. a staging table
+    """
+    columns = columns or table.columns.keys()
+    encoders = [(k, _encoder(table.c[k])) for k in columns]
+
+    buf = io.StringIO()
+    for row in rows:
+        values = []
+        for key, encode in encoders:
+            value = row.get(key)
+            values.append(NULL if value is None else encode(
+                value).translate(_escapes))
+        buf.write('\t'.join(values))
+        buf.write('\n')
+    buf.seek(0)
+
+    preparer = conn.dialect.identifier_preparer
+    sql = 'COPY {} ({}) FROM STDIN'.format(
+        target or preparer.format_table(table),
+        ', '.join(preparer.quote(table.c[k].name) for k in columns))
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(sql, buf)
+    finally:
+        cursor.close()
+
+
+def on_conflict(conn, table, columns):
+    """
+    `ON CONFLICT` clause merging rows of `columns` into `table` by primary
+    key, only updating rows when one of their values changed.
+    """
+    primary_key = [c.key for c in table.primary_key.columns]
+    preparer = conn.dialect.identifier_preparer
+    target = preparer.format_table(table)
+    updated = [preparer.quote(table.c[k].name) for k in columns if k not in primary_key]
+    if updated:
+        action = 'UPDATE SET {} WHERE ({}) IS DISTINCT FROM ({})'.format(
+            ', '.join('{0} = excluded.{0}'.format(n) for n in updated),
+            ', '.join('{}.{}'.format(target, n) for n in updated),
+            ', '.join('excluded.{}'.format(n) for n in updated))
+    else:
+        action = 'NOTHING'
+    return 'ON CONFLICT ({}) DO {}'.format(
+        ', '.join(preparer.quote(table.c[k].name) for k in primary_key), action)
+
+
+def bulk_upsert(conn, table, rows):
+    """
+    Load rows into a temporary staging table with COPY, then merge them into
+    `table` with a single `INSERT ... SELECT ... ON CONFLICT DO UPDATE`.
+    Rows must already be deduplicated by primary key, and are only updated
+    when one of their values changed.
+
+    Return:
+        int: rows inserted or updated
+    """
+    columns = [k for k in table.columns.keys()
+               if any(k in row for row in rows)]
+    preparer = conn.dialect.identifier_preparer
+    staging = preparer.quote('_pipet_staging_' + table.name)
+    names = ', '.join(preparer.quote(table.c[k].name) for k in columns)
+
+    conn.execute('CREATE TEMPORARY TABLE {} (LIKE {} INCLUDING DEFAULTS)'.format(
+        staging, preparer.format_table(table)))
+    copy_rows(conn, table, rows, columns, target=staging)
+
+    result = conn.execute('INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} '
+                          '{on_conflict}'.format(
+                              table=preparer.format_table(table),
+                              columns=names,
+                              staging=staging,
+                              on_conflict=on_conflict(conn, table, columns)))
+    conn.execute('DROP TABLE {}'.format(staging))
+    return result.rowcount
+
+
+def is_empty(conn, table):
+    return not conn.execute(select([exists().select_from(table)])).scalar()
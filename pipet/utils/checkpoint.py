@@ -0,0 +1,42 @@
+from sqlalchemy import Column, Table, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import func
+from sqlalchemy.types import DateTime, Text
+
+
+def checkpoint_table(metadata):
+    """
+    Sync cursors stored in the warehouse next to a source's tables, so a
+    cursor commits in the same transaction as the rows it covers.
+    """
+    return Table('_pipet_checkpoints', metadata,
+                 Column('name', Text, primary_key=True),
+                 Column('cursor', Text),
+                 Column('updated_at', DateTime, server_default=func.now()))
+
+
+def load_checkpoint(conn, table, name):
+    """
+    Return:
+        str: the cursor saved for `name`, or None
+    """
+    return conn.execute(select([table.c.cursor]).where(
+        table.c.name == name)).scalar()
+
+
+def save_checkpoint(conn, table, name, cursor):
+    """
+    Save a cursor. It's only durable once the caller commits, together with
+    the rows written since the last checkpoint.
+    """
+    stmt = insert(table).values(name=name, cursor=cursor, updated_at=func.now())
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.name],
+        set_={'cursor': stmt.excluded.cursor, 'updated_at': stmt.excluded.updated_at}))
+
+
+def delete_checkpoints(conn, table, names):
+    """
+    Forget the cursors of `names`, so they sync again from the start.
+    """
+    conn.execute(table.delete().where(table.c.name.in_(names)))
@@ -0,0 +1,133 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+
+WAREHOUSE_POOL_SIZE = int(os.environ.get('WAREHOUSE_POOL_SIZE', 2))
+WAREHOUSE_MAX_OVERFLOW = int(os.environ.get('WAREHOUSE_MAX_OVERFLOW', 3))
+WAREHOUSE_POOL_RECYCLE = int(os.environ.get('WAREHOUSE_POOL_RECYCLE', 30 * 60))
+WAREHOUSE_IDLE_TIMEOUT = int(os.environ.get('WAREHOUSE_IDLE_TIMEOUT', 10 * 60))
+WAREHOUSE_MAX_ENGINES = int(os.environ.get('WAREHOUSE_MAX_ENGINES', 50))
+
+
+class _Entry():
+    def __init__(self, credentials, engine):
+        self.credentials = credentials
+        self.engine = engine
+        self.session_factory = sessionmaker(bind=engine)
+        self.created = self.last_used = time.time()
+
+
+class EngineRegistry():
+    """
+    Process-wide cache of warehouse engines, one per organization.
+
+    Engines are rebuilt when an organization's credentials change, and
+    disposed once they have been idle for `idle_timeout` seconds or when
+    more than `max_engines` are open, least recently used first.
+    """
+
+    def __init__(self, pool_size=WAREHOUSE_POOL_SIZE, max_overflow=WAREHOUSE_MAX_OVERFLOW,
+                 pool_recycle=WAREHOUSE_POOL_RECYCLE, idle_timeout=WAREHOUSE_IDLE_TIMEOUT,
+                 max_engines=WAREHOUSE_MAX_ENGINES):
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_recycle = pool_recycle
+        self.idle_timeout = idle_timeout
+        self.max_engines = max_engines
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        # Connections must not be shared with a forked parent (Celery
+        # prefork workers), so forget inherited engines without closing them.
+        if self._pid != os.getpid():
+            self._entries = OrderedDict()
+            self._pid = os.getpid()
+
+    def _create_engine(self, credentials):
+        return create_engine(credentials,
+                             use_batch_mode=True,
+                             pool_size=self.pool_size,
+                             max_overflow=self.max_overflow,
+                             pool_recycle=self.pool_recycle,
+                             pool_pre_ping=True)
+
+    def _entry(self, key, credentials):
+        with self._lock:
+            self._check_pid()
+            entry = self._entries.pop(key, None)
+            if entry and entry.credentials != credentials:
+                entry.engine.dispose()
+                entry = None
+            if not entry:
+                entry = _Entry(credentials, self._create_engine(credentials))
+            entry.last_used = time.time()
+            self._entries[key] = entry
+            self.evict()
+            return entry
+
+    def get(self, key, credentials):
+        """
+        Args:
+            key: organization id
+            credentials (str): database URI
+        Return:
+            Engine
+        """
+        return self._entry(key, credentials).engine
+
+    def session(self, key, credentials):
+        """
+        Return a new session bound to the cached engine. Callers should
+        close it so its connection goes back to the pool.
+        """
+        return self._entry(key, credentials).session_factory()
+
+    def dispose(self, key):
+        with self._lock:
+            self._check_pid()
+            entry = self._entries.pop(key, None)
+            if entry:
+                entry.engine.dispose()
+
+    def evict(self, now=None):
+        """
+        Dispose engines that are idle or over the `max_engines` limit.
+        Engines with connections checked out are never evicted.
+        """
+        now = now or time.time()
+        with self._lock:
+            self._check_pid()
+            overflow = len(self._entries) - self.max_engines
+            for key, entry in list(self._entries.items()):
+                if entry.engine.pool.checkedout():
+                    continue
+                if overflow > 0 or now - entry.last_used > self.idle_timeout:
+                    del self._entries[key]
+                    entry.engine.dispose()
+                    overflow -= 1
+
+    def stats(self):
+        """
+        Return:
+            dict: pool statistics keyed by organization id
+        """
+        with self._lock:
+            self._check_pid()
+            now = time.time()
+            return {key: {
+                'size': entry.engine.pool.size(),
+                'checked_in': entry.engine.pool.checkedin(),
+                'checked_out': entry.engine.pool.checkedout(),
+                'overflow': entry.engine.pool.overflow(),
+                'idle_seconds': int(now - entry.last_used),
+            } for key, entry in self._entries.items()}
+
+
+engines = EngineRegistry()
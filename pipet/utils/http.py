@@ -0,0 +1,71 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Number of hosts with pooled connections, per session
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 10))
+# Number of kept-alive connections per host
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 10))
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 60))
+
+_sessions = {}
+_lock = threading.Lock()
+_pid = os.getpid()
+
+
+def get_session(name, pool_connections=None, pool_maxsize=None):
+    """
+    Return the process-wide `requests.Session` for a source, so requests to
+    the same API reuse kept-alive connections instead of a new TCP and TLS
+    handshake per page.
+
+    Args:
+        name (str): source name, e.g. 'stripe'
+        pool_connections (int): number of hosts to keep pools for
+        pool_maxsize (int): connections kept per host
+    Return:
+        requests.Session
+    """
+    global _pid
+    with _lock:
+        # Sockets must not be shared with a forked parent
+        if _pid != os.getpid():
+            _sessions.clear()
+            _pid = os.getpid()
+
+        if name not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=pool_connections or HTTP_POOL_CONNECTIONS,
+                pool_maxsize=pool_maxsize or HTTP_POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            _sessions[name] = session
+        return _sessions[name]
+
+
+def stats():
+    """
+    Return:
+        dict: requests, new connections and reused connections by source,
+            for the connection pools currently open in this process
+    """
+    result = {}
+    with _lock:
+        for name, session in _sessions.items():
+            pools = session.get_adapter('https://').poolmanager.pools
+            num_requests = num_connections = 0
+            for key in pools.keys():
+                pool = pools[key]
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+            result[name] = {
+                'requests': num_requests,
+                'connections': num_connections,
+                'reused': num_requests - num_connections,
+            }
+    return result
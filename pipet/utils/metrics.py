@@ -0,0 +1,191 @@
+from contextlib import contextmanager
+import json
+import time
+
+
+# name: (type, help)
+METRICS = {
+    'rows_fetched_total': ('counter', 'Rows fetched from source APIs'),
+    'rows_written_total': ('counter', 'Rows written to warehouses'),
+    'rows_skipped_total': ('counter', 'Upserted rows left alone because they were unchanged'),
+    'pages_fetched_total': ('counter', 'Pages fetched from source APIs'),
+    'api_request_seconds': ('summary', 'Source API request latency'),
+    'api_throttled_total': ('counter', 'Source API requests throttled with a 429'),
+    'rate_limit_wait_seconds_total': ('counter', 'Seconds spent waiting for rate limits'),
+    'db_write_seconds': ('summary', 'Warehouse batch write latency'),
+    'sync_run_seconds': ('summary', 'Duration of sync runs'),
+    'sync_lag_seconds': ('gauge', 'Seconds since the last sync run that caught up'),
+    'sync_interval_seconds': ('gauge', 'Current adaptive sync interval'),
+    'ingest_buffered_rows': ('gauge', 'Rows waiting in the ingestion buffer'),
+    'warehouse_pool_size': ('gauge', 'Connections kept by a warehouse engine pool'),
+    'warehouse_pool_checked_in': ('gauge', 'Idle connections in a warehouse engine pool'),
+    'warehouse_pool_checked_out': ('gauge', 'Warehouse connections in use'),
+    'warehouse_pool_overflow': ('gauge', 'Warehouse connections opened beyond the pool size'),
+    'warehouse_engine_idle_seconds': ('gauge', 'Seconds since a warehouse engine was last used'),
+    'http_requests_total': ('counter', 'Source API requests sent over pooled connections'),
+    'http_connections_total': ('counter', 'Source API connections opened'),
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                               for k, v in sorted(labels.items())) + '}'
+    return '{} {}'.format(name, repr(float(value)))
+
+
+class Metrics():
+    """
+    Counters and summaries shared by every web and worker process through a
+    Redis hash, rendered in the Prometheus text format. Gauges of a
+    process's own state are published by the process, see `publish`.
+
+    Samples are labelled freely, typically by source, account and resource
+    (table), so slow accounts and hot tables can be found.
+    """
+
+    def __init__(self, redis, prefix='pipet'):
+        self.redis = redis
+        self.prefix = prefix
+        self.key = '{}:metrics'.format(prefix)
+
+    def _field(self, name, labels):
+        if name not in METRICS:
+            raise ValueError('Unknown metric {}'.format(name))
+        return json.dumps([name, sorted((k, str(v)) for k, v in labels.items())])
+
+    def inc(self, name, value=1, **labels):
+        self.redis.hincrbyfloat(self.key, self._field(name, labels), value)
+
+    def observe(self, name, value, **labels):
+        """
+        Add an observation to a summary, kept as its count and sum.
+        """
+        field = self._field(name, labels)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hincrbyfloat(self.key, field + ':count', 1)
+        pipe.hincrbyfloat(self.key, field + ':sum', value)
+        pipe.execute()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def record_write(self, written, seconds, skipped=None, **labels):
+        """
+        Args:
+            written (dict): rows written by table name, as returned by
+                `UpsertBatch.execute`
+            seconds (float): time the write took
+            skipped (dict): unchanged rows by table name, `UpsertBatch.skipped`
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for table, rows in written.items():
+            pipe.hincrbyfloat(self.key, self._field(
+                'rows_written_total', dict(labels, resource=table)), rows)
+        for table, rows in (skipped or {}).items():
+            pipe.hincrbyfloat(self.key, self._field(
+                'rows_skipped_total', dict(labels, resource=table)), rows)
+        field = self._field('db_write_seconds', labels)
+        pipe.hincrbyfloat(self.key, field + ':count', 1)
+        pipe.hincrbyfloat(self.key, field + ':sum', seconds)
+        pipe.execute()
+
+    def write_batch(self, batch, conn, bulk=False, **labels):
+        """
+        Execute an `UpsertBatch`, recording its rows and latency.
+
+        Return:
+            dict: rows written by table name
+        """
+        start = time.time()
+        written = batch.execute(conn, bulk=bulk)
+        self.record_write(written, time.time() - start, skipped=batch.skipped, **labels)
+        return written
+
+    def record_page(self, rows, **labels):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hincrbyfloat(self.key, self._field('pages_fetched_total', labels), 1)
+        pipe.hincrbyfloat(self.key, self._field('rows_fetched_total', labels), rows)
+        pipe.execute()
+
+    def publish(self, process, samples, ttl):
+        """
+        Replace the gauges only `process` can read, such as the state of its
+        connection pools. They expire `ttl` seconds after the last
+        publication, so those of exited processes go away.
+
+        Args:
+            process (str): e.g. `<hostname>:<pid>`, added as a label
+            samples (list): (name, labels, value)
+        """
+        for name, _, _ in samples:
+            if name not in METRICS:
+                raise ValueError('Unknown metric {}'.format(name))
+        self.redis.setex('{}:process:{}'.format(self.key, process), ttl, json.dumps(
+            [[name, {k: str(v) for k, v in dict(labels, process=process).items()}, value]
+             for name, labels, value in samples]))
+
+    def published(self):
+        """
+        Return:
+            list: (name, labels, value) gauges published by live processes
+        """
+        samples = []
+        for key in self.redis.scan_iter(match=self.key + ':process:*'):
+            value = self.redis.get(key)
+            if value is not None:
+                samples.extend(tuple(s) for s in json.loads(value.decode('utf-8')))
+        return samples
+
+    def samples(self):
+        """
+        Return:
+            list: (name, labels, suffix, value) for every stored sample
+        """
+        samples = []
+        for field, value in self.redis.hgetall(self.key).items():
+            field = field.decode('utf-8')
+            suffix = ''
+            if field.endswith((':count', ':sum')):
+                field, suffix = field.rsplit(':', 1)
+                suffix = '_' + suffix
+            name, labels = json.loads(field)
+            samples.append((name, dict(labels), suffix, float(value)))
+        return samples
+
+    def render(self, gauges=()):
+        """
+        Args:
+            gauges (iterable): (name, labels, value) samples computed at
+                scrape time, e.g. from the sync schedules
+        Return:
+            str: every metric in the Prometheus text format, with the
+                gauges published by processes
+        """
+        by_name = {}
+        for name, labels, suffix, value in self.samples():
+            by_name.setdefault(name, []).append((name + suffix, labels, value))
+        for name, labels, value in list(gauges) + self.published():
+            by_name.setdefault(name, []).append((name, labels, value))
+
+        lines = []
+        for name in sorted(by_name):
+            metric_type, help = METRICS[name]
+            full_name = '{}_{}'.format(self.prefix, name)
+            lines.append('# HELP {} {}'.format(full_name, help))
+            lines.append('# TYPE {} {}'.format(full_name, metric_type))
+            for sample, labels, value in sorted(by_name[name], key=lambda s: (s[0], sorted(s[1].items()))):
+                lines.append(format_sample('{}_{}'.format(self.prefix, sample), labels, value))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        self.redis.delete(self.key)
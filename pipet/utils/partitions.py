@@ -0,0 +1,147 @@
+from datetime import date, datetime, timedelta
+import os
+
+from sqlalchemy import text
+
+
+# Partitions created ahead of today, so writes never wait on DDL
+PARTITION_PRECREATE_DAYS = int(os.environ.get('PARTITION_PRECREATE_DAYS', 7))
+
+
+def partition_start(interval, day):
+    """
+    Args:
+        interval (str): 'day' or 'month'
+        day (date):
+    Return:
+        date: first day of the partition containing `day`
+    """
+    return day.replace(day=1) if interval == 'month' else day
+
+
+def next_partition_start(interval, start):
+    if interval == 'month':
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def partition_name(table, interval, start):
+    return '{}_p{}'.format(table.name, start.strftime(
+        '%Y%m' if interval == 'month' else '%Y%m%d'))
+
+
+def parse_partition_name(table, interval, name):
+    """
+    Return:
+        date: first day of the partition called `name`, or None if it isn't
+            one of the table's range partitions, e.g. the default partition
+    """
+    prefix = table.name + '_p'
+    if not name.startswith(prefix):
+        return None
+    try:
+        return datetime.strptime(name[len(prefix):],
+                                 '%Y%m' if interval == 'month' else '%Y%m%d').date()
+    except ValueError:
+        return None
+
+
+def _qualify(conn, table, name):
+    preparer = conn.dialect.identifier_preparer
+    return '{}.{}'.format(preparer.quote_schema(table.schema), preparer.quote(name))
+
+
+def is_partitioned(conn, table):
+    """
+    Tables created before partitioning was introduced are left alone.
+    """
+    return bool(conn.execute(text(
+        'SELECT 1 FROM pg_partitioned_table WHERE partrelid = CAST(:parent AS regclass)'),
+        parent=conn.dialect.identifier_preparer.format_table(table)).scalar())
+
+
+def list_partitions(conn, table):
+    """
+    Return:
+        list: names of the table's partitions
+    """
+    rows = conn.execute(text(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = CAST(:parent AS regclass)'),
+        parent=conn.dialect.identifier_preparer.format_table(table))
+    return [row[0] for row in rows]
+
+
+def create_partitions(conn, table, interval, today=None, days=PARTITION_PRECREATE_DAYS):
+    """
+    Create the partitions covering today and the next `days` days, and a
+    default partition for rows outside of them, such as late events.
+
+    Return:
+        list: names of the partitions created
+    """
+    today = today or date.today()
+    parent = conn.dialect.identifier_preparer.format_table(table)
+    existing = set(list_partitions(conn, table))
+    created = []
+
+    default = table.name + '_default'
+    if default not in existing:
+        conn.execute('CREATE TABLE {} PARTITION OF {} DEFAULT'.format(
+            _qualify(conn, table, default), parent))
+        created.append(default)
+
+    start = partition_start(interval, today)
+    while start <= today + timedelta(days=days):
+        end = next_partition_start(interval, start)
+        name = partition_name(table, interval, start)
+        if name not in existing:
+            conn.execute("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ('{}') TO ('{}')".format(
+                _qualify(conn, table, name),
+                parent, start.isoformat(), end.isoformat()))
+            created.append(name)
+        start = end
+    return created
+
+
+def drop_partitions(conn, table, interval, retention_days, today=None):
+    """
+    Drop partitions whose rows are all older than `retention_days`. Rows in
+    the default partition are kept.
+
+    Return:
+        list: names of the partitions dropped
+    """
+    if not retention_days:
+        return []
+    cutoff = (today or date.today()) - timedelta(days=retention_days)
+    dropped = []
+    for name in list_partitions(conn, table):
+        start = parse_partition_name(table, interval, name)
+        if start and next_partition_start(interval, start) <= cutoff:
+            conn.execute('DROP TABLE {}'.format(
+                _qualify(conn, table, name)))
+            dropped.append(name)
+    return sorted(dropped)
+
+
+def maintain_partitions(conn, tables, today=None):
+    """
+    Create upcoming partitions and drop expired ones for partitioned tables
+    configured through `Table.info`, e.g.
+    `{'partition_interval': 'day', 'retention_days': 90}`.
+
+    Return:
+        dict: created and dropped partition names by table name
+    """
+    changes = {}
+    for table in tables:
+        if not is_partitioned(conn, table):
+            continue
+        interval = table.info['partition_interval']
+        changes[table.name] = {
+            'created': create_partitions(conn, table, interval, today),
+            'dropped': drop_partitions(conn, table, interval,
+                                       table.info.get('retention_days'), today),
+        }
+    return changes
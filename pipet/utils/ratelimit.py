@@ -0,0 +1,239 @@
+import logging
+import random
+import threading
+import time
+
+
+class TokenBucket():
+    """
+    Thread-safe token bucket. `rate` tokens are added per second, up to
+    `capacity`, and `acquire` blocks until a token is available.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        """
+        Return:
+            float: 0 if the tokens were taken, otherwise seconds to wait
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.paused_until > now:
+                return self.paused_until - now
+            self._refill(now)
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """
+        Return:
+            float: seconds spent waiting
+        """
+        waited = 0
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = time.monotonic() + seconds
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(key, rate, capacity=None):
+    """
+    Return the process-wide bucket for `key`, creating it if needed.
+    """
+    with _buckets_lock:
+        if key not in _buckets:
+            _buckets[key] = TokenBucket(rate, capacity)
+        return _buckets[key]
+
+
+# Takes tokens from a bucket stored as a Redis hash, unless the bucket is
+# paused. Returns the number of seconds to wait, as a string since Redis
+# truncates Lua numbers to integers.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+
+local paused = tonumber(redis.call('GET', KEYS[2]) or 0)
+if paused > now then
+    return tostring(paused - now)
+end
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+
+class RedisTokenBucket():
+    """
+    Token bucket shared by every worker through Redis. Besides the usual
+    refill, the bucket can be paused, e.g. for an API's `Retry-After`.
+    """
+
+    def __init__(self, redis, key, rate, capacity=None):
+        self.redis = redis
+        self.key = key
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def try_acquire(self, tokens=1):
+        return float(self._script(keys=[self.key, self.key + ':paused'],
+                                  args=[self.rate, self.capacity, time.time(), tokens]))
+
+    def acquire(self, tokens=1):
+        waited = 0
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        until = time.time() + seconds
+        self.redis.set(self.key + ':paused', until, ex=int(seconds) + 1)
+
+
+class RateLimited(Exception):
+    """
+    Raised when an API keeps throttling requests after every retry. Sync
+    state is checkpointed, so the next run resumes the throttled work.
+    """
+
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__(
+            'Rate limited, retry after {:.0f}s'.format(retry_after))
+        self.retry_after = retry_after
+
+
+class RequestScheduler():
+    """
+    Central scheduler for a source's API requests.
+
+    Every request takes a token from the account's bucket and, if
+    `source_rate` is set, from a bucket shared by all accounts of the
+    source. Buckets live in Redis so concurrent workers share the budget;
+    without Redis they are per process.
+
+    Throttled (429) and failed (5xx) requests are retried with jittered
+    exponential backoff. A 429's `Retry-After` pauses the account's bucket
+    for every worker.
+
+    With `metrics`, request latency, throttling and rate limit waits are
+    recorded per account.
+    """
+
+    def __init__(self, name, rate, capacity=None, source_rate=None, redis=None,
+                 max_retries=5, backoff=1, max_backoff=120, metrics=None):
+        self.name = name
+        self.metrics = metrics
+        self.rate = rate
+        self.capacity = capacity
+        self.source_rate = source_rate
+        self.redis = redis
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def _bucket(self, key, rate, capacity=None):
+        if self.redis is None:
+            return get_bucket(key, rate, capacity)
+        return RedisTokenBucket(self.redis, 'ratelimit:' + ':'.join(map(str, key)), rate, capacity)
+
+    def bucket(self, account_id):
+        return self._bucket((self.name, account_id), self.rate, self.capacity)
+
+    def acquire(self, account_id):
+        """
+        Return:
+            float: seconds spent waiting for the rate limit
+        """
+        waited = 0
+        if self.source_rate:
+            waited += self._bucket((self.name, ), self.source_rate).acquire()
+        return waited + self.bucket(account_id).acquire()
+
+    def delay(self, attempt, response=None):
+        retry_after = response is not None and response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def request(self, account_id, send):
+        """
+        Args:
+            account_id: key of the account's bucket
+            send (callable): performs the request and returns the response
+        Return:
+            requests.Response
+        """
+        for attempt in range(self.max_retries + 1):
+            waited = self.acquire(account_id)
+            start = time.time()
+            resp = send()
+            if self.metrics:
+                labels = {'source': self.name, 'account': account_id}
+                self.metrics.observe('api_request_seconds', time.time() - start, **labels)
+                if waited:
+                    self.metrics.inc('rate_limit_wait_seconds_total', waited, **labels)
+                if resp.status_code == 429:
+                    self.metrics.inc('api_throttled_total', **labels)
+
+            if resp.status_code != 429 and resp.status_code < 500:
+                return resp
+
+            delay = self.delay(attempt, resp)
+            logging.warning('{} returned {} for account {}, retrying in {:.1f}s'.format(
+                self.name, resp.status_code, account_id, delay))
+
+            if resp.status_code == 429:
+                if attempt == self.max_retries:
+                    raise RateLimited(delay)
+                # The paused bucket makes every worker wait, this one included
+                self.bucket(account_id).pause(delay)
+            elif attempt < self.max_retries:
+                time.sleep(delay)
+
+        return resp
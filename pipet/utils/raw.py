@@ -0,0 +1,174 @@
+from datetime import datetime, timedelta
+import os
+
+from sqlalchemy import Column, Index, Table, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import ARRAY, JSON, JSONB
+from sqlalchemy.sql import func
+from sqlalchemy.types import BigInteger, DateTime, String
+
+from pipet.utils.bulk import on_conflict
+from pipet.utils.checkpoint import load_checkpoint, save_checkpoint
+
+
+# Land API objects verbatim in raw tables, materializing the typed tables
+# from them in the warehouse, instead of parsing and upserting every object
+RAW_LANDING = bool(int(os.environ.get('RAW_LANDING', 0)))
+# Seconds between materializations
+MATERIALIZE_INTERVAL = int(os.environ.get('MATERIALIZE_INTERVAL', 60))
+# Seconds before the watermark read again by every materialization, so
+# objects landed by transactions that committed late aren't missed
+MATERIALIZE_OVERLAP = int(os.environ.get('MATERIALIZE_OVERLAP', 5 * 60))
+# Days of materialized raw objects kept, 0 keeps them forever so typed
+# tables can be rebuilt after a schema change without refetching
+RAW_RETENTION_DAYS = int(os.environ.get('RAW_RETENTION_DAYS', 0))
+
+WATERMARK_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def raw_table(table, metadata):
+    """
+    Define the append-only raw table of a typed table, in the same schema,
+    and link it from `table.info['raw']`.
+
+    Raw tables are defined on their own `metadata`, so the typed tables'
+    `create_all` leaves them out and they're only created by
+    `create_raw_tables` once raw landing is on.
+
+    Objects are landed with COPY and stamped with the landing transaction's
+    time. `seq` orders the versions of an object landed together.
+    """
+    raw = Table('_raw_' + table.name, metadata,
+                Column('seq', BigInteger, primary_key=True),
+                Column('id', String, nullable=False),
+                Column('object', String),
+                Column('fetched_at', DateTime, server_default=func.now(), nullable=False),
+                Column('payload', JSONB, nullable=False),
+                # BRIN indexes stay tiny on insert-ordered data
+                Index('ix__raw_{}_fetched_at'.format(table.name), 'fetched_at',
+                      postgresql_using='brin'))
+    table.info['raw'] = raw
+    return raw
+
+
+def create_raw_tables(conn, models, checkpoints):
+    """
+    Create the raw tables, and the checkpoint table holding their watermarks,
+    in warehouses set up before raw landing was turned on.
+    """
+    checkpoints.create(conn, checkfirst=True)
+    for m in models:
+        m.__table__.info['raw'].create(conn, checkfirst=True)
+
+
+def json_expression(column, field, payload='raw.payload'):
+    """
+    SQL reading `field` of the JSON object `payload` as `column`'s type, the
+    in-warehouse counterpart of parsing it. Field names come from the
+    models' parse plans, never from API data.
+    """
+    value = "{}->'{}'".format(payload, field)
+    if isinstance(column.type, JSON):
+        return value
+    type_ = column.type.compile(dialect=postgresql.dialect())
+    if isinstance(column.type, ARRAY):
+        return ("CASE jsonb_typeof({0}) WHEN 'array' THEN "
+                "CAST(ARRAY(SELECT jsonb_array_elements_text({0})) AS {1}) END").format(value, type_)
+    value = "{}->>'{}'".format(payload, field)
+    if isinstance(column.type, String):
+        return value
+    return 'CAST({} AS {})'.format(value, type_)
+
+
+def elements(value):
+    """
+    Return:
+        str: SQL set of the elements of a JSON array, none if it's null or
+            missing
+    """
+    return "jsonb_array_elements(CASE jsonb_typeof({0}) WHEN 'array' THEN {0} ELSE '[]' END)".format(value)
+
+
+def latest(conn, raw):
+    """
+    Return:
+        str: FROM clause of the newest version of every object landed
+            between `:since` and `:until`, as `raw.id` and `raw.payload`
+    """
+    return ('(SELECT DISTINCT ON (id) id, payload FROM {} '
+            'WHERE fetched_at > :since AND fetched_at <= :until '
+            'ORDER BY id, fetched_at DESC, seq DESC) AS raw').format(
+                conn.dialect.identifier_preparer.format_table(raw))
+
+
+def upsert_from(conn, table, columns, source, params):
+    """
+    Upsert into `table` from a query, one row per primary key.
+
+    Args:
+        table (Table):
+        columns (list): (column key, SQL expression) pairs
+        source (str): FROM clause, bound by `params`
+    Return:
+        dict: rows written by table name
+    """
+    preparer = conn.dialect.identifier_preparer
+    expressions = dict(columns)
+    primary_key = [expressions[c.key] for c in table.primary_key.columns]
+    result = conn.execute(text(
+        'INSERT INTO {table} ({names}) SELECT DISTINCT ON ({primary_key}) {expressions} '
+        'FROM {source} WHERE {not_null} ORDER BY {primary_key} {on_conflict}'.format(
+            table=preparer.format_table(table),
+            names=', '.join(preparer.quote(table.c[k].name) for k, _ in columns),
+            primary_key=', '.join(primary_key),
+            expressions=', '.join(e for _, e in columns),
+            source=source,
+            not_null=' AND '.join('{} IS NOT NULL'.format(e) for e in primary_key),
+            on_conflict=on_conflict(conn, table, [k for k, _ in columns]))), **params)
+    return {table.name: result.rowcount}
+
+
+def insert_from(conn, table, columns, source, params):
+    """
+    Like `upsert_from`, for tables without a primary key.
+    """
+    preparer = conn.dialect.identifier_preparer
+    result = conn.execute(text('INSERT INTO {} ({}) SELECT {} FROM {}'.format(
+        preparer.format_table(table),
+        ', '.join(preparer.quote(table.c[k].name) for k, _ in columns),
+        ', '.join(e for _, e in columns),
+        source)), **params)
+    return {table.name: result.rowcount}
+
+
+def materialize(conn, cls, checkpoints, selection=None,
+                overlap=MATERIALIZE_OVERLAP, retention_days=RAW_RETENTION_DAYS):
+    """
+    Materialize `cls`'s typed tables from the objects landed in its raw
+    table since the last run, whose watermark, the newest `fetched_at`
+    materialized, is checkpointed with the rows. The caller commits.
+
+    Args:
+        cls: model with a raw table
+        checkpoints (Table): the source's checkpoint table
+        selection (SyncConfig): tables and columns synced
+    Return:
+        dict: rows written by table name
+    """
+    raw = cls.__table__.info['raw']
+    name = 'raw:' + cls.__tablename__
+    until = conn.execute(select([func.max(raw.c.fetched_at)])).scalar()
+    watermark = load_checkpoint(conn, checkpoints, name)
+    watermark = watermark and datetime.strptime(watermark, WATERMARK_FORMAT)
+    if until is None or watermark and until <= watermark:
+        return {}
+
+    since = watermark - timedelta(seconds=overlap) if watermark else datetime(1970, 1, 1)
+    written = cls.materialize(conn, latest(conn, raw), {'since': since, 'until': until},
+                              selection)
+
+    if retention_days:
+        conn.execute(raw.delete().where(raw.c.fetched_at < min(
+            since, until - timedelta(days=retention_days))))
+    save_checkpoint(conn, checkpoints, name, until.strftime(WATERMARK_FORMAT))
+    return written
@@ -0,0 +1,210 @@
+import json
+import os
+import random
+import time
+
+
+# Seconds between sync runs, adapted per account between the bounds
+SYNC_MIN_INTERVAL = int(os.environ.get('SYNC_MIN_INTERVAL', 30))
+SYNC_MAX_INTERVAL = int(os.environ.get('SYNC_MAX_INTERVAL', 30 * 60))
+SYNC_DEFAULT_INTERVAL = int(os.environ.get('SYNC_DEFAULT_INTERVAL', 60))
+# Seconds a dispatched run may go without renewing its lease before it's
+# considered lost and redispatched
+SYNC_LEASE = int(os.environ.get('SYNC_LEASE', 60 * 60))
+# Seconds between lease renewals of a running sync
+SYNC_HEARTBEAT_INTERVAL = int(os.environ.get('SYNC_HEARTBEAT_INTERVAL', 60))
+# Seconds between dispatches of due syncs, and most syncs started by one
+SYNC_DISPATCH_INTERVAL = int(os.environ.get('SYNC_DISPATCH_INTERVAL', 5))
+SYNC_DISPATCH_LIMIT = int(os.environ.get('SYNC_DISPATCH_LIMIT', 100))
+
+
+# Takes the members due at ARGV[1], most overdue first, and pushes them
+# back by the lease so they aren't dispatched again while they run.
+DUE_SCRIPT = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(members) do
+    redis.call('ZADD', KEYS[1], ARGV[3], member)
+end
+return members
+"""
+
+
+class SyncSchedule():
+    """
+    Per-account sync schedule of a source, kept in a Redis sorted set of
+    members scored by when they're next due.
+
+    Instead of every account syncing on a fixed beat, each member has its own
+    interval: halved after a run that wrote rows, doubled after an idle one,
+    within `min_interval` and `max_interval`. Members that fell behind, e.g.
+    because they were rate limited, are due again after the shortest
+    interval, whatever their own. New members
+    start at a random point of their first interval so they don't all sync
+    at once.
+
+    Alongside, a hash keeps each member's interval, last run and lag, the
+    seconds since its last run that finished caught up.
+    """
+
+    def __init__(self, redis, name, min_interval=SYNC_MIN_INTERVAL,
+                 max_interval=SYNC_MAX_INTERVAL, default_interval=SYNC_DEFAULT_INTERVAL,
+                 lease=SYNC_LEASE):
+        self.redis = redis
+        self.name = name
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_interval = default_interval
+        self.lease = lease
+        self.key = 'schedule:{}'.format(name)
+        self.state_key = 'schedule:{}:state'.format(name)
+        self._due = redis.register_script(DUE_SCRIPT)
+
+    def members(self):
+        return [m.decode('utf-8') for m in self.redis.zrange(self.key, 0, -1)]
+
+    def add(self, member, now=None):
+        """
+        Schedule a member if it isn't already.
+
+        Return:
+            bool: whether the member was added
+        """
+        now = now or time.time()
+        due = now + random.uniform(0, self.default_interval)
+        return bool(self.redis.execute_command('ZADD', self.key, 'NX', due, member))
+
+    def remove(self, member):
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.key, member)
+        pipe.hdel(self.state_key, member)
+        pipe.execute()
+
+    def sync(self, members, now=None):
+        """
+        Make the schedule match `members`, e.g. the source's accounts.
+
+        Return:
+            tuple: members added, members removed
+        """
+        members = set(str(m) for m in members)
+        scheduled = set(self.members())
+        for member in members - scheduled:
+            self.add(member, now)
+        for member in scheduled - members:
+            self.remove(member)
+        return sorted(members - scheduled), sorted(scheduled - members)
+
+    def due(self, limit=100, now=None):
+        """
+        Take up to `limit` members that are due, most overdue first. They
+        aren't returned again until they `complete` or their lease runs out.
+        """
+        now = now or time.time()
+        members = self._due(keys=[self.key], args=[now, limit, now + self.lease])
+        return [m.decode('utf-8') for m in members]
+
+    def renew(self, member, lock_key=None, now=None):
+        """
+        Extend the lease of a running member, and the task lock `lock_key`
+        if given, so a long run such as a backfill isn't dispatched again
+        while it's still going.
+        """
+        now = now or time.time()
+        pipe = self.redis.pipeline()
+        # XX: a member removed while it runs stays removed
+        pipe.execute_command('ZADD', self.key, 'XX', now + self.lease, member)
+        if lock_key:
+            pipe.expire(lock_key, self.lease)
+        pipe.execute()
+
+    def heartbeat(self, member, lock_key=None, interval=SYNC_HEARTBEAT_INTERVAL):
+        """
+        Return:
+            function: to call as often as convenient while the member runs,
+                renewing its lease at most every `interval` seconds
+        """
+        last = [time.time()]
+
+        def beat(now=None):
+            now = now or time.time()
+            if now - last[0] >= interval:
+                last[0] = now
+                self.renew(member, lock_key, now)
+        return beat
+
+    def state(self, member):
+        raw = self.redis.hget(self.state_key, member)
+        return json.loads(raw.decode('utf-8')) if raw else {}
+
+    def states(self):
+        """
+        Return:
+            dict: state of every member that has run
+        """
+        return {k.decode('utf-8'): json.loads(v.decode('utf-8'))
+                for k, v in self.redis.hgetall(self.state_key).items()}
+
+    def complete(self, member, rows, behind=False, min_interval=None, now=None):
+        """
+        Record a run and schedule the member's next one.
+
+        Args:
+            member (str):
+            rows (int): rows written by the run
+            behind (bool): the run stopped before catching up
+            min_interval (int): overrides `min_interval`, e.g. for accounts
+                that also receive webhooks
+        Return:
+            float: seconds until the member is due again
+        """
+        now = now or time.time()
+        min_interval = max(min_interval or 0, self.min_interval)
+        max_interval = max(min_interval, self.max_interval)
+        state = self.state(member)
+        interval = state.get('interval', self.default_interval)
+
+        if behind:
+            delay = self.min_interval
+        else:
+            interval = interval / 2 if rows else interval * 2
+            interval = min(max_interval, max(min_interval, interval))
+            # Jitter keeps members that happen to line up from staying lined up
+            delay = interval * random.uniform(0.9, 1.1)
+
+        caught_up = state.get('caught_up', now) if behind else now
+        state.update({
+            'interval': interval,
+            'last_run': now,
+            'rows': rows,
+            'behind': behind,
+            'caught_up': caught_up,
+        })
+        pipe = self.redis.pipeline()
+        pipe.hset(self.state_key, member, json.dumps(state))
+        # XX: a member removed while it ran stays removed
+        pipe.execute_command('ZADD', self.key, 'XX', now + delay, member)
+        pipe.execute()
+        return delay
+
+    def lag(self, member, now=None):
+        """
+        Return:
+            float: seconds since the member was last caught up, None if it
+                never was
+        """
+        caught_up = self.state(member).get('caught_up')
+        return None if caught_up is None else (now or time.time()) - caught_up
+
+    def stats(self, now=None):
+        """
+        Return:
+            dict: scheduled, due and behind member counts, and the largest lag
+        """
+        now = now or time.time()
+        states = list(self.states().values())
+        return {
+            'scheduled': self.redis.zcard(self.key),
+            'due': self.redis.zcount(self.key, '-inf', now),
+            'behind': sum(1 for s in states if s.get('behind')),
+            'max_lag': max([now - s['caught_up'] for s in states] or [0]),
+        }
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+
+
+def table_choices(metadata):
+    """
+    Return:
+        OrderedDict: a source's tables that can be chosen by name, leaving
+            out pipet's own such as checkpoints
+    """
+    return OrderedDict(sorted((t.name, t) for t in metadata.tables.values()
+                              if not t.name.startswith('_')))
+
+
+class SyncConfig():
+    """
+    Which of a source's tables an account syncs, and optionally which of
+    their columns, stored on the account as
+    `{<table name>: [<column key>, ...] or null}`.
+
+    An empty configuration syncs everything, so accounts that never chose
+    keep their behaviour. Primary key columns are always kept, since rows
+    are upserted by them.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or {}
+
+    def enabled(self, table):
+        """
+        Args:
+            table (str): table name
+        """
+        return not self.config or table in self.config
+
+    def models(self, models):
+        """
+        Return:
+            list: the enabled ones of `models`
+        """
+        return [m for m in models if self.enabled(m.__tablename__)]
+
+    def columns(self, table):
+        """
+        Args:
+            table (Table):
+        Return:
+            set: column keys kept for `table`, None for all of them
+        """
+        columns = self.config.get(table.name)
+        if not columns:
+            return None
+        return set(columns) | set(c.key for c in table.primary_key.columns)
+
+    def project(self, table, rows, keep=()):
+        columns = self.columns(table)
+        if columns is None:
+            return rows
+        columns |= set(keep)
+        return [{k: v for k, v in row.items() if k in columns} for row in rows]
+
+    def apply(self, batch):
+        """
+        Drop the rows of disabled tables and the unselected columns from an
+        `UpsertBatch`, in place.
+
+        Return:
+            UpsertBatch: `batch`
+        """
+        if not self.config:
+            return batch
+
+        batch.landed = OrderedDict((table, objects) for table, objects in batch.landed.items()
+                                   if self.enabled(table.name))
+        for attr in ('upserts', 'inserts'):
+            setattr(batch, attr, OrderedDict(
+                (table, self.project(table, rows))
+                for table, rows in getattr(batch, attr).items() if self.enabled(table.name)))
+
+        batch.replacements = OrderedDict(
+            (table, (parent_column, OrderedDict(
+                (parent_id, self.project(table, rows, keep=[parent_column]))
+                for parent_id, rows in children.items())))
+            for table, (parent_column, children) in batch.replacements.items()
+            if self.enabled(table.name))
+        return batch
+
+    @classmethod
+    def from_form(cls, tables, columns, choices):
+        """
+        Args:
+            tables (list): names of the checked tables
+            columns (str): one `table: column, column` line per table whose
+                columns are limited
+            choices (dict): every table of the source by name, see
+                `table_choices`
+        Return:
+            dict: configuration to store, None if everything is synced
+        Raises:
+            ValueError: for a table that isn't synced or an unknown column
+        """
+        config = OrderedDict((table, None) for table in tables)
+        for line in (columns or '').splitlines():
+            if not line.strip():
+                continue
+            table, _, keys = line.partition(':')
+            table = table.strip()
+            if table not in config:
+                raise ValueError('{} is not a synced table'.format(table))
+            keys = [k.strip() for k in keys.split(',') if k.strip()]
+            unknown = [k for k in keys if k not in choices[table].c]
+            if unknown:
+                raise ValueError('{} has no column {}'.format(table, ', '.join(unknown)))
+            config[table] = keys or None
+
+        if set(config) >= set(choices) and not any(config.values()):
+            return None
+        return config
+
+    def to_form(self, choices):
+        """
+        Return:
+            tuple: (checked tables, columns text), the inverse of `from_form`
+        """
+        tables = [t for t in choices if self.enabled(t)]
+        columns = '\n'.join('{}: {}'.format(t, ', '.join(c))
+                            for t, c in self.config.items() if c)
+        return tables, columns
@@ -0,0 +1,74 @@
+import fakeredis
+import pytest
+
+from pipet.api.auth import AuthCache
+from pipet.api.validation import ValidationError, parse_batch, parse_payload, validate
+
+
+def test_validate_normalizes_created():
+    row = validate('event', {'type': 'signup', 'created': '2018-03-01T12:00:00+01:00'})
+    assert row['created'] == '2018-03-01T11:00:00'
+
+
+def test_validate_rejects_bad_created():
+    for created in ('soon', 1519905600, {}):
+        with pytest.raises(ValidationError):
+            validate('event', {'type': 'signup', 'created': created})
+
+
+def test_validate_rejects_created_outside_partitions():
+    with pytest.raises(ValidationError):
+        validate('event', {'type': 'signup', 'created': '2999-01-01T00:00:00'})
+
+
+def test_parse_payload_rejects_unparsable_body():
+    assert parse_payload('event', {'type': 'signup'}) == [('event', {'type': 'signup'})]
+    assert parse_payload('event', []) == []
+    with pytest.raises(ValidationError):
+        parse_payload('event', None)
+
+
+def test_parse_batch_rejects_unparsable_body():
+    assert parse_batch({'batch': [{'kind': 'page'}]}) == [('page', {'kind': 'page'})]
+    for data in (None, [], {'batch': [{'kind': 'unknown'}]}):
+        with pytest.raises(ValidationError):
+            parse_batch(data)
+
+
+class FakeLookup():
+    def __init__(self, keys):
+        self.keys = keys
+        self.calls = 0
+
+    def __call__(self, username, password):
+        self.calls += 1
+        return self.keys.get((username, password))
+
+
+def test_auth_cache_caches_lookups():
+    lookup = FakeLookup({('acme', 'key'): 1})
+    cache = AuthCache(fakeredis.FakeStrictRedis(), lookup=lookup)
+
+    assert cache.authenticate('acme', 'key') == 1
+    assert cache.authenticate('acme', 'key') == 1
+    assert cache.authenticate('acme', 'bad') is None
+    assert cache.authenticate('acme', 'bad') is None
+    assert lookup.calls == 2
+    assert cache.stats() == {'entries': 2, 'hits': 2, 'misses': 2}
+
+
+def test_auth_cache_invalidates_rotated_keys_in_every_process():
+    redis = fakeredis.FakeStrictRedis()
+    lookup = FakeLookup({('acme', 'old'): 1, ('other', 'key'): 2})
+    cache = AuthCache(redis, lookup=lookup, check_interval=0)
+    other_process = AuthCache(redis, lookup=lookup, check_interval=0)
+    for c in (cache, other_process):
+        assert c.authenticate('acme', 'old') == 1
+        assert c.authenticate('other', 'key') == 2
+
+    lookup.keys = {('acme', 'new'): 1, ('other', 'key'): 2}
+    cache.invalidate(1)
+    assert cache.stats()['entries'] == 1
+    for c in (cache, other_process):
+        assert c.authenticate('acme', 'old') is None
+        assert c.authenticate('acme', 'new') == 1
@@ -3,8 +3,15 @@ import pytest
 from unittest import TestCase
 
 from dotenv import find_dotenv, load_dotenv
+import fakeredis
 import stripe
 
+from pipet.sources.stripe import StripeAccount
+from pipet.sources.stripe.coalesce import Coalescer
+from pipet.sources.stripe.models import Charge, Refund, collect_remaining_children
+from pipet.utils import UpsertBatch
+from pipet.utils.syncconfig import SyncConfig
+
 
 load_dotenv(find_dotenv())
 TEST_STRIPE_API_KEY = os.environ.get('TEST_STRIPE_API_KEY')
@@ -19,3 +26,106 @@ class StripeTest(TestCase):
 
         # create customers
         customers_created = [stripe.Customer.create() for i in range(101)]
+
+
+def test_reenabled_classes_are_backfilled_again():
+    account = StripeAccount(cursors={}, backfilled=False)
+    account.set_sync_config({'customers': None})
+    # backfilled and updated without charges, whose events were skipped
+    account.cursors = {'customers': {'cursor': None, 'done': True}}
+    account.backfilled = True
+
+    account.set_sync_config({'customers': None, 'refunds': None})
+    assert not account.backfilled
+    assert 'charges' not in account.cursors
+    assert account.cursors['customers']['done']
+
+    account.cursors = {'customers': {'cursor': None, 'done': True},
+                       'charges': {'cursor': None, 'done': True},
+                       'refunds': {'cursor': None, 'done': True}}
+    account.backfilled = True
+    account.set_sync_config({'customers': None, 'refunds': None, 'charges': None})
+    assert not account.backfilled
+    assert 'charges' not in account.cursors
+    assert 'refunds' in account.cursors
+
+
+class FakeResponse():
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeAccount():
+    def __init__(self, pages, sync_config=None):
+        self.pages = pages
+        self.requests = []
+        self.selection = SyncConfig(sync_config)
+
+    def get(self, path, params):
+        self.requests.append((path, dict(params)))
+        return FakeResponse(self.pages.pop(0))
+
+
+def refund(id):
+    return {'id': id, 'object': 'refund', 'amount': 100}
+
+
+def test_remaining_children_are_paged_from_the_last_embedded_one():
+    batch = UpsertBatch()
+    truncated = Charge.collect(batch, {
+        'id': 'ch_1', 'object': 'charge',
+        'refunds': {'data': [refund('re_1')], 'has_more': True},
+    })
+    account = FakeAccount([{'data': [refund('re_2'), refund('re_3')], 'has_more': True},
+                           {'data': [refund('re_4')], 'has_more': False}])
+
+    collect_remaining_children(account, batch, truncated)
+    assert account.requests == [
+        ('/v1/charges/ch_1/refunds', {'starting_after': 're_1'}),
+        ('/v1/charges/ch_1/refunds', {'starting_after': 're_3'}),
+    ]
+    refunds = batch.upserts[Refund.__table__]
+    assert [r['id'] for r in refunds] == ['re_1', 're_2', 're_3', 're_4']
+    assert all(r['charge_id'] == 'ch_1' for r in refunds)
+
+    account = FakeAccount([], {'charges': None})
+    collect_remaining_children(account, UpsertBatch(), truncated)
+    assert account.requests == []
+
+
+def customer(name):
+    return {'object': 'customer', 'id': 'cus_1', 'description': name}
+
+
+def test_coalescer_keeps_the_newest_version():
+    coalescer = Coalescer(fakeredis.FakeStrictRedis(), 1)
+    assert coalescer.add(customer('new'), 20)
+    assert not coalescer.add(customer('old'), 10)
+    assert coalescer.drain() == [(20, customer('new'))]
+    assert coalescer.drain() == []
+
+
+def test_coalescer_drops_versions_older_than_the_written_one():
+    coalescer = Coalescer(fakeredis.FakeStrictRedis(), 1)
+    coalescer.add(customer('new'), 20)
+    coalescer.written(coalescer.drain())
+
+    assert not coalescer.add(customer('old'), 10)
+    assert coalescer.drain() == []
+    assert coalescer.add(customer('newer'), 30)
+
+
+def test_coalescer_restore_keeps_newer_pending_versions():
+    coalescer = Coalescer(fakeredis.FakeStrictRedis(), 1)
+    coalescer.add(customer('old'), 10)
+    objects = coalescer.drain()
+    coalescer.add(customer('new'), 20)
+
+    coalescer.restore(objects)
+    assert coalescer.drain() == [(20, customer('new'))]
@@ -0,0 +1,289 @@
+from datetime import date
+import time
+
+import fakeredis
+import pytest
+from sqlalchemy import Column, Table, create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.declarative import as_declarative
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import MetaData
+from sqlalchemy.types import BigInteger, Text
+
+from pipet.utils import PipetBase, UpsertBatch
+from pipet.utils import engines
+from pipet.utils.engines import EngineRegistry
+from pipet.utils.metrics import Metrics
+from pipet.utils.partitions import next_partition_start, parse_partition_name, partition_name
+from pipet.utils.ratelimit import RateLimited, RequestScheduler, TokenBucket
+from pipet.utils.raw import json_expression
+from pipet.utils.scheduler import SyncSchedule
+from pipet.utils.syncconfig import SyncConfig, table_choices
+
+
+@as_declarative(metadata=MetaData(schema='test'))
+class Base(PipetBase):
+    id = Column(Text, primary_key=True)
+
+
+class Widget(Base):
+    amount = Column(BigInteger)
+    name = Column(Text)
+
+
+widget_parts = Table('widget_parts', Base.metadata,
+                     Column('widget_id', Text),
+                     Column('name', Text))
+
+
+def compile(statement):
+    return statement.compile(dialect=postgresql.dialect())
+
+
+def test_batch_groups_rows_into_multi_row_upserts():
+    batch = UpsertBatch()
+    for i in range(10):
+        batch.upsert(Widget, {'id': str(i), 'amount': i})
+
+    statements = batch.statements()
+    assert len(statements) == 1
+    assert len(compile(statements[0]).params) == 20
+    assert 'ON CONFLICT (id) DO UPDATE' in str(compile(statements[0]))
+
+
+def test_batch_dedupes_by_primary_key_last_wins():
+    batch = UpsertBatch()
+    batch.upsert(Widget, {'id': 'a', 'amount': 1})
+    batch.upsert(Widget, {'id': 'a', 'amount': 2})
+
+    params = compile(batch.statements()[0]).params
+    assert params == {'id_m0': 'a', 'amount_m0': 2}
+
+
+def test_batch_respects_batch_size():
+    batch = UpsertBatch(batch_size=3)
+    for i in range(7):
+        batch.upsert(Widget, {'id': str(i), 'amount': i})
+
+    assert len(batch.statements()) == 3
+
+
+def test_batch_only_updates_columns_present():
+    batch = UpsertBatch()
+    batch.upsert(Widget, {'id': 'a', 'amount': 1})
+    batch.upsert(Widget, {'id': 'b', 'name': 'b'})
+
+    sql = [str(compile(s)) for s in batch.statements()]
+    assert len(sql) == 2
+    assert 'SET amount = excluded.amount' in sql[0]
+    assert 'SET name = excluded.name' in sql[1]
+
+
+def test_batch_only_updates_changed_rows():
+    batch = UpsertBatch()
+    batch.upsert(Widget, {'id': 'a', 'amount': 1, 'name': 'a'})
+
+    sql = str(compile(batch.statements()[0]))
+    assert 'WHERE (test.widgets.amount, test.widgets.name) IS DISTINCT FROM ' \
+        '(excluded.amount, excluded.name)' in sql
+
+
+def test_batch_replaces_children_of_touched_parents():
+    batch = UpsertBatch()
+    batch.replace_children(widget_parts, 'widget_id', 'a', [{'name': 'x'}])
+    batch.replace_children(widget_parts, 'widget_id', 'b', [])
+    batch.replace_children(widget_parts, 'widget_id', 'a', [{'name': 'y'}, {'name': 'z'}])
+
+    delete, insert = [compile(s) for s in batch.statements()]
+    assert str(delete).startswith('DELETE FROM test.widget_parts')
+    assert sorted(delete.params.values()) == ['a', 'b']
+    assert sorted(v for k, v in insert.params.items() if k.startswith('name')) == ['y', 'z']
+
+
+def test_json_expression_casts_to_column_type():
+    columns = Widget.__table__.c
+    assert json_expression(columns.name, 'name') == "raw.payload->>'name'"
+    assert json_expression(columns.amount, 'amount') == "CAST(raw.payload->>'amount' AS BIGINT)"
+
+
+def test_sync_config_drops_disabled_tables_and_columns():
+    batch = UpsertBatch()
+    batch.upsert(Widget, {'id': 'a', 'amount': 1, 'name': 'a'})
+    batch.replace_children(widget_parts, 'widget_id', 'a', [{'name': 'x'}])
+
+    SyncConfig({'widgets': ['name']}).apply(batch)
+    assert batch.upserts == {Widget.__table__: [{'id': 'a', 'name': 'a'}]}
+    assert not batch.replacements
+
+
+def test_sync_config_from_form():
+    choices = table_choices(Base.metadata)
+    assert list(choices) == ['widget_parts', 'widgets']
+    assert SyncConfig.from_form(list(choices), '', choices) is None
+    assert SyncConfig.from_form(['widgets'], 'widgets: name, amount', choices) == \
+        {'widgets': ['name', 'amount']}
+    with pytest.raises(ValueError):
+        SyncConfig.from_form(['widgets'], 'widget_parts: name', choices)
+    with pytest.raises(ValueError):
+        SyncConfig.from_form(['widgets'], 'widgets: amout', choices)
+
+
+def test_token_bucket_allows_burst_then_waits():
+    bucket = TokenBucket(rate=10, capacity=2)
+
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert 0 < bucket.try_acquire() <= 0.1
+
+
+class FakeResponse():
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def test_scheduler_retries_throttled_requests():
+    responses = [FakeResponse(429, {'Retry-After': '0'}), FakeResponse(200)]
+    scheduler = RequestScheduler('test', rate=100)
+
+    resp = scheduler.request(1, lambda: responses.pop(0))
+    assert resp.status_code == 200
+    assert not responses
+
+
+def test_scheduler_raises_when_throttled_after_retries():
+    scheduler = RequestScheduler('test', rate=100, max_retries=2)
+
+    with pytest.raises(RateLimited):
+        scheduler.request(2, lambda: FakeResponse(429, {'Retry-After': '0'}))
+
+
+def test_sync_schedule_enrolls_and_leases_members():
+    schedule = SyncSchedule(fakeredis.FakeStrictRedis(), 'test', default_interval=60, lease=600)
+
+    assert schedule.sync([1, 2], now=1000) == (['1', '2'], [])
+    assert schedule.due(now=1000) == []
+    assert sorted(schedule.due(now=1060)) == ['1', '2']
+    # leased until they complete or the lease runs out
+    assert schedule.due(now=1100) == []
+    assert sorted(schedule.due(now=1660)) == ['1', '2']
+
+    assert schedule.sync([2], now=1700) == ([], ['1'])
+    assert schedule.members() == ['2']
+
+
+def test_sync_schedule_renews_leases_of_running_members():
+    redis = fakeredis.FakeStrictRedis()
+    schedule = SyncSchedule(redis, 'test', default_interval=60, lease=600)
+    schedule.add('1', now=1000)
+    redis.set('lock', 1, ex=5)
+
+    assert schedule.due(now=1100) == ['1']
+    schedule.renew('1', 'lock', now=1500)
+    assert schedule.due(now=1800) == []
+    assert schedule.due(now=2100) == ['1']
+    assert redis.ttl('lock') > 5
+
+
+def test_sync_schedule_complete_adapts_interval():
+    schedule = SyncSchedule(fakeredis.FakeStrictRedis(), 'test', min_interval=30,
+                            max_interval=240, default_interval=60)
+    schedule.add('1', now=1000)
+
+    assert 27 <= schedule.complete('1', rows=10, now=1100) <= 33
+    assert schedule.state('1')['interval'] == 30
+    schedule.complete('1', rows=0, now=1200)
+    schedule.complete('1', rows=0, now=1300)
+    assert schedule.state('1')['interval'] == 120
+
+    assert schedule.complete('1', rows=10, behind=True, now=1400) == 30
+    assert schedule.lag('1', now=1500) == 200
+    assert schedule.due(now=1430) == ['1']
+
+
+class SqliteRegistry(EngineRegistry):
+    # use_batch_mode is Postgres only
+    def _create_engine(self, credentials):
+        return create_engine(credentials, poolclass=QueuePool,
+                             pool_size=self.pool_size, max_overflow=self.max_overflow)
+
+
+def test_engine_registry_reuses_engines_until_credentials_change():
+    registry = SqliteRegistry()
+    engine = registry.get(1, 'sqlite://')
+
+    assert registry.get(1, 'sqlite://') is engine
+    assert registry.get(2, 'sqlite://') is not engine
+    assert registry.get(1, 'sqlite:///:memory:') is not engine
+    assert sorted(registry.stats()) == [1, 2]
+
+
+def test_engine_registry_disposes_idle_engines_not_in_use():
+    registry = SqliteRegistry(idle_timeout=60, max_engines=2)
+    registry.get(1, 'sqlite://')
+    conn = registry.get(2, 'sqlite://').connect()
+    assert registry.stats()[2]['checked_out'] == 1
+
+    registry.evict(now=time.time() + 120)
+    assert list(registry.stats()) == [2]
+    conn.close()
+    registry.evict(now=time.time() + 120)
+    assert registry.stats() == {}
+
+    # least recently used first when over max_engines
+    for key in (1, 2, 3):
+        registry.get(key, 'sqlite://')
+    assert list(registry.stats()) == [2, 3]
+
+
+def test_engine_registry_forgets_engines_of_the_parent_process(monkeypatch):
+    registry = SqliteRegistry()
+    engine = registry.get(1, 'sqlite://')
+
+    monkeypatch.setattr(engines.os, 'getpid', lambda: -1)
+    assert registry.stats() == {}
+    assert registry.get(1, 'sqlite://') is not engine
+
+
+def test_metrics_render_counters_summaries_and_gauges():
+    metrics = Metrics(fakeredis.FakeStrictRedis())
+    metrics.inc('api_throttled_total', source='stripe')
+    metrics.inc('api_throttled_total', 2, source='stripe')
+    metrics.observe('sync_run_seconds', 1.5, source='stripe')
+    metrics.observe('sync_run_seconds', 0.5, source='stripe')
+    metrics.publish('web:1', [('warehouse_pool_size', {'organization': 1}, 2)], ttl=60)
+    with pytest.raises(ValueError):
+        metrics.inc('unknown_total')
+
+    lines = metrics.render([('sync_lag_seconds', {'source': 'stripe', 'account': 'a"b'}, 30)])
+    assert lines.splitlines() == [
+        '# HELP pipet_api_throttled_total Source API requests throttled with a 429',
+        '# TYPE pipet_api_throttled_total counter',
+        'pipet_api_throttled_total{source="stripe"} 3.0',
+        '# HELP pipet_sync_lag_seconds Seconds since the last sync run that caught up',
+        '# TYPE pipet_sync_lag_seconds gauge',
+        'pipet_sync_lag_seconds{account="a\\"b",source="stripe"} 30.0',
+        '# HELP pipet_sync_run_seconds Duration of sync runs',
+        '# TYPE pipet_sync_run_seconds summary',
+        'pipet_sync_run_seconds_count{source="stripe"} 2.0',
+        'pipet_sync_run_seconds_sum{source="stripe"} 2.0',
+        '# HELP pipet_warehouse_pool_size Connections kept by a warehouse engine pool',
+        '# TYPE pipet_warehouse_pool_size gauge',
+        'pipet_warehouse_pool_size{organization="1",process="web:1"} 2.0',
+    ]
+
+    metrics.reset()
+    assert 'pipet_api_throttled_total' not in metrics.render()
+    assert 'process="web:1"' in metrics.render()
+
+
+def test_partition_names_round_trip():
+    table = Widget.__table__
+    start = date(2018, 12, 1)
+
+    assert next_partition_start('month', start) == date(2019, 1, 1)
+    assert next_partition_start('day', date(2018, 12, 31)) == date(2019, 1, 1)
+    for interval in ('day', 'month'):
+        name = partition_name(table, interval, start)
+        assert parse_partition_name(table, interval, name) == start
+    assert parse_partition_name(table, 'day', 'widgets_default') is None
@@ -1,5 +1,100 @@
+from pipet.models import Organization as PipetOrganization, db
+from pipet.sources.zendesk import ZendeskAccount
+from pipet.sources.zendesk.models import Base, Organization, Ticket, raw_metadata
+
+
 def inc(x):
     return x + 1
 
 def test_answer():
     assert inc(3) == 4
+
+
+class FakeResponse():
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeAccount():
+    def __init__(self, page):
+        self.page = page
+        self.requests = []
+
+    def get(self, path, params=None):
+        self.requests.append(params)
+        return FakeResponse(self.page)
+
+
+def test_sync_resumes_int_cursors_as_start_time():
+    account = FakeAccount({'tickets': [], 'after_cursor': 'abc', 'end_of_stream': True})
+    _, cursor, has_more = Ticket.sync(account, 1519905600)
+    assert account.requests[0]['start_time'] == '1519905600'
+    assert 'cursor' not in account.requests[0]
+    assert (cursor, has_more) == ('abc', False)
+
+    account = FakeAccount({'organizations': [], 'end_time': 1519905600, 'end_of_stream': False})
+    _, cursor, has_more = Organization.sync(account, 1519905600)
+    assert (cursor, has_more) == ('1519905600', False)
+
+
+class FakeBind():
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, statement):
+        self.executed.append(statement)
+
+
+class FakeSession():
+    def __init__(self):
+        self.bind = FakeBind()
+        self.committed = []
+
+    def connection(self):
+        return self.bind
+
+    def add(self, obj):
+        pass
+
+    def commit(self):
+        self.committed.append(True)
+
+    def close(self):
+        pass
+
+
+def test_reset_resyncs_from_the_start(monkeypatch):
+    monkeypatch.setattr(Base.metadata, 'drop_all', lambda bind: None)
+    monkeypatch.setattr(Base.metadata, 'create_all', lambda bind: None)
+    monkeypatch.setattr(raw_metadata, 'drop_all', lambda bind: None)
+    db_session = FakeSession()
+    monkeypatch.setattr(db, 'session', db_session)
+
+    zendesk_account = ZendeskAccount(cursors={'tickets': 'abc'})
+    zendesk_account.reset(FakeSession())
+    assert db_session.committed
+    assert zendesk_account.initialized
+
+    account = FakeAccount({'tickets': [], 'after_cursor': 'def', 'end_of_stream': True})
+    Ticket.sync(account, zendesk_account.cursors.get('tickets'))
+    assert account.requests[0]['start_time'] == 0
+
+
+def test_reenabled_endpoints_sync_from_the_start(monkeypatch):
+    warehouse = FakeSession()
+    organization = PipetOrganization()
+    monkeypatch.setattr(organization, 'create_session', lambda: warehouse)
+    zendesk_account = ZendeskAccount(organization=organization, initialized=True, cursors={})
+
+    zendesk_account.set_sync_config({'users': None})
+    zendesk_account.cursors = {'users': 'abc', 'tickets': 'def'}
+    zendesk_account.set_sync_config({'users': None, 'tickets': None})
+    assert zendesk_account.cursors == {'users': 'abc'}
+    assert warehouse.committed
+    assert list(warehouse.bind.executed[0].compile().params.values()) == ['tickets']